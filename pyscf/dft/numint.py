@@ -345,8 +345,9 @@ def eval_mat(mol, ao, weight, rho, vxc,
         else:
             vrho = vxc
         # *.5 because return mat + mat.T
+        # numpy.multiply is faster than einsum('pi,p->pi') to scale the rows
         aow = numpy.empty_like(ao)
-        aow = numpy.einsum('pi,p->pi', ao, .5*weight*vrho, out=aow)
+        aow = numpy.multiply(ao, (.5*weight*vrho).reshape(-1,1), out=aow)
         mat = _dot_ao_ao(mol, ao, aow, non0tab, shls_slice, ao_loc)
     else:
         #wv = weight * vsigma * 2
@@ -356,15 +357,16 @@ def eval_mat(mol, ao, weight, rho, vxc,
         #aow += numpy.einsum('pi,p->pi', ao[0], .5*weight*vrho)
         vrho, vsigma = vxc[:2]
         wv = numpy.empty((4,ngrids))
+        numpy.multiply(weight, vrho, out=wv[0])
+        wv[0] *= .5
+        # Products are written to wv in place to avoid (3,ngrids) temporaries
         if spin == 0:
             assert(vsigma is not None and rho.ndim==2)
-            wv[0]  = weight * vrho * .5
-            wv[1:4] = rho[1:4] * (weight * vsigma * 2)
+            numpy.multiply(rho[1:4], weight * vsigma * 2, out=wv[1:4])
         else:
             rho_a, rho_b = rho
-            wv[0]  = weight * vrho * .5
-            wv[1:4] = rho_a[1:4] * (weight * vsigma[0] * 2)  # sigma_uu
-            wv[1:4]+= rho_b[1:4] * (weight * vsigma[1])      # sigma_ud
+            numpy.multiply(rho_a[1:4], weight * vsigma[0] * 2, out=wv[1:4])  # sigma_uu
+            wv[1:4] += rho_b[1:4] * (weight * vsigma[1])                     # sigma_ud
         aow = numpy.empty_like(ao[0])
         aow = numpy.einsum('npi,np->pi', ao[:4], wv, out=aow)
         mat = _dot_ao_ao(mol, ao[0], aow, non0tab, shls_slice, ao_loc)
@@ -374,19 +376,18 @@ def eval_mat(mol, ao, weight, rho, vxc,
     if xctype == 'MGGA':
         vlapl, vtau = vxc[2:]
         if vlapl is None:
-            vlpal = 0
-        aow = numpy.einsum('pi,p->pi', ao[1], weight*(.25*vtau+vlapl), out=aow)
-        mat += _dot_ao_ao(mol, ao[1], aow, non0tab, shls_slice, ao_loc)
-        aow = numpy.einsum('pi,p->pi', ao[2], weight*(.25*vtau+vlapl), out=aow)
-        mat += _dot_ao_ao(mol, ao[2], aow, non0tab, shls_slice, ao_loc)
-        aow = numpy.einsum('pi,p->pi', ao[3], weight*(.25*vtau+vlapl), out=aow)
-        mat += _dot_ao_ao(mol, ao[3], aow, non0tab, shls_slice, ao_loc)
+            vlapl = 0
+        wv = weight * (.25*vtau+vlapl)
+        for i in range(1, 4):
+            aow = numpy.multiply(ao[i], wv.reshape(-1,1), out=aow)
+            mat += _dot_ao_ao(mol, ao[i], aow, non0tab, shls_slice, ao_loc)
 
         XX, YY, ZZ = 4, 7, 9
         ao2 = ao[XX] + ao[YY] + ao[ZZ]
-        aow = numpy.einsum('pi,p->pi', ao2, .5 * weight * vlapl, out=aow)
+        aow = numpy.multiply(ao2, (.5*weight*vlapl).reshape(-1,1), out=aow)
         mat += _dot_ao_ao(mol, ao[0], aow, non0tab, shls_slice, ao_loc)
-    return mat + mat.T.conj()
+    # mat + mat.T.conj() without allocating the conjugate transpose
+    return lib.hermi_sum(mat, inplace=True)
 
 
 def _dot_ao_ao(mol, ao1, ao2, non0tab, shls_slice, ao_loc, hermi=0):
@@ -12,9 +12,12 @@ DMRG solver for CASCI and CASSCF.
 import ctypes
 import os
 import sys
+import glob
 import struct
 import time
+import itertools
 import tempfile
+import warnings
 from subprocess import check_call, check_output, STDOUT, CalledProcessError
 import numpy
 import pyscf.tools
@@ -146,6 +149,9 @@ class DMRGCI(pyscf.lib.StreamObject):
 # This flag _restart is set by the program internally, to control when to make
 # Block restart calculation.
         self._restart = False
+# The 2-PDMs parsed from the Block output files, see _load_twopdm.  The cache
+# is emptied whenever Block runs.
+        self._twopdm_cache = {}
         self.generate_schedule()
 
         self._keys = set(self.__dict__.keys())
@@ -242,16 +248,8 @@ class DMRGCI(pyscf.lib.StreamObject):
         else:
             nelectrons = nelec[0]+nelec[1]
 
-        twopdm = numpy.zeros( (norb, norb, norb, norb) )
         file2pdm = "spatial_twopdm.%d.%d.txt" %(state, state)
-        with open(os.path.join(self.scratchDirectory, "node0", file2pdm), "r") as f:
-            norb_read = int(f.readline().split()[0])
-            assert(norb_read == norb)
-
-            for line in f:
-                linesp = line.split()
-                i, k, l, j = [int(x) for x in linesp[:4]]
-                twopdm[i,j,k,l] = 2.0 * float(linesp[4])
+        twopdm = self._load_twopdm(file2pdm, norb)
 
         onepdm = numpy.einsum('ikjj->ik', twopdm)
         onepdm /= (nelectrons-1)
@@ -285,21 +283,32 @@ class DMRGCI(pyscf.lib.StreamObject):
                                      'specificpdm %d %d' % (statebra, stateket)])
         executeBLOCK(self)
 
-        twopdm = numpy.zeros( (norb, norb, norb, norb) )
         file2pdm = "spatial_twopdm.%d.%d.txt" %(statebra, stateket)
-        with open(os.path.join(self.scratchDirectory, "node0", file2pdm), "r") as f:
-            norb_read = int(f.readline().split()[0])
-            assert(norb_read == norb)
-
-            for line in f:
-                linesp = line.split()
-                i, k, l, j = [int(x) for x in linesp[:4]]
-                twopdm[i,j,k,l] = 2.0 * float(linesp[4])
+        twopdm = self._load_twopdm(file2pdm, norb)
 
         onepdm = numpy.einsum('ikjj->ik', twopdm)
         onepdm /= (nelectrons-1)
         return onepdm, twopdm
 
+    def _load_twopdm(self, file2pdm, norb):
+        '''Read the 2-PDM from the Block text file file2pdm.  make_rdm1,
+        make_rdm1s and make_rdm12 read the same file, so the parsed 2-PDM is
+        kept until Block runs again or the file changes.
+        '''
+        fname = os.path.join(self.scratchDirectory, "node0", file2pdm)
+        stat = os.stat(fname)
+        key = (fname, stat.st_mtime, stat.st_size)
+        if key not in self._twopdm_cache:
+            twopdm = numpy.zeros( (norb, norb, norb, norb) )
+            with open(fname, "r") as f:
+                norb_read = int(f.readline().split()[0])
+                assert(norb_read == norb)
+
+                (i, k, l, j), val = _read_pdm_txt(f, 4)
+                twopdm[i,j,k,l] = 2.0 * val
+            self._twopdm_cache[key] = twopdm
+        return self._twopdm_cache[key].copy()
+
     def make_rdm123(self, state, norb, nelec, link_index=None, **kwargs):
         if self.has_threepdm == False:
             writeDMRGConfFile(self, nelec, True,
@@ -326,10 +335,8 @@ class DMRGCI(pyscf.lib.StreamObject):
             norb_read = int(f.readline().split()[0])
             assert(norb_read == norb)
 
-            for line in f:
-                linesp = line.split()
-                i, j, k, l, m, n = [int(x) for x in linesp[:6]]
-                threepdm[i,j,k,l,m,n] = float(linesp[6])
+            idx, val = _read_pdm_txt(f, 6)
+            threepdm[tuple(idx)] = val
 
         twopdm = numpy.einsum('ijkklm->ijlm',threepdm)
         twopdm /= (nelectrons-2)
@@ -346,13 +353,25 @@ class DMRGCI(pyscf.lib.StreamObject):
         '''
         onepdm, twopdm, threepdm = self.make_rdm123(state, norb, nelec, None, **kwargs)
         threepdm = numpy.einsum('mkijln->ijklmn',threepdm).copy()
-        threepdm += numpy.einsum('jk,lm,in->ijklmn',numpy.identity(norb),numpy.identity(norb),onepdm)
-        threepdm += numpy.einsum('jk,miln->ijklmn',numpy.identity(norb),twopdm)
-        threepdm += numpy.einsum('lm,kijn->ijklmn',numpy.identity(norb),twopdm)
-        threepdm += numpy.einsum('jm,kinl->ijklmn',numpy.identity(norb),twopdm)
-
-        twopdm =(numpy.einsum('iklj->ijkl',twopdm)
-               + numpy.einsum('il,jk->ijkl',onepdm,numpy.identity(norb)))
+        # The delta functions of the terms below only touch the diagonals
+        # j=k, l=m or j=m.  Add the terms to those diagonals (strided views
+        # of threepdm) instead of contracting with identity matrices.
+        # threepdm += einsum('jk,lm,in->ijklmn', I, I, onepdm)
+        diag = threepdm.reshape(norb,norb*norb,norb*norb,norb)[:,::norb+1,::norb+1]
+        diag += onepdm[:,None,None,:]
+        # threepdm += einsum('jk,miln->ijklmn', I, twopdm)
+        diag = threepdm.reshape(norb,norb*norb,norb,norb,norb)[:,::norb+1]
+        diag += twopdm.transpose(1,2,0,3)[:,None]
+        # threepdm += einsum('lm,kijn->ijklmn', I, twopdm)
+        diag = threepdm.reshape(norb,norb,norb,norb*norb,norb)[:,:,:,::norb+1]
+        diag += twopdm.transpose(1,2,0,3)[:,:,:,None]
+        # threepdm += einsum('jm,kinl->ijklmn', I, twopdm)
+        for j in range(norb):
+            threepdm[:,j,:,:,j] += twopdm.transpose(1,0,3,2)
+
+        # twopdm = einsum('iklj->ijkl', twopdm) + einsum('il,jk->ijkl', onepdm, I)
+        twopdm = twopdm.transpose(0,3,1,2).copy()
+        twopdm.reshape(norb,norb*norb,norb)[:,::norb+1] += onepdm[:,None]
 
         return onepdm, twopdm, threepdm
 
@@ -378,14 +397,18 @@ class DMRGCI(pyscf.lib.StreamObject):
             self.extraline.pop()
 
         # Remove everything
-        os.system("rm -f %s/node0/*twopdm*"%(self.scratchDirectory))
-        os.system("rm -f %s/node0/*tmp"%(self.scratchDirectory))
+        _remove_files(os.path.join(self.scratchDirectory, "node0", "*twopdm*"))
+        _remove_files(os.path.join(self.scratchDirectory, "node0", "*tmp"))
+
+        # Fall back to the text file if Block did not write the binary file
+        fname = os.path.join(self.scratchDirectory,"node0", "spatial_threepdm.%d.%d.bin" %(state, state))
+        if (filetype == "binary" and not os.path.isfile(fname)):
+            filetype = "text"
 
         # The binary files coming from STACKBLOCK and BLOCK are different
         # - STACKBLOCK uses the 6-fold symmetry, this must unpacked using "libunpack.unpackE3" (see lib/icmpspt/icmpspt.c)
         # - BLOCK just writes a list of all values, this is directly read by "unpackE3_BLOCK"
         if (filetype == "binary") :
-            fname = os.path.join(self.scratchDirectory,"node0", "spatial_threepdm.%d.%d.bin" %(state, state))
             if 'stackblock' in settings.BLOCKEXE:
               print 'Reading binary 3RDM from STACKBLOCK'
               fnameout = os.path.join(self.scratchDirectory,"node0", "spatial_threepdm.%d.%d.bin.unpack" %(state, state))
@@ -401,20 +424,16 @@ class DMRGCI(pyscf.lib.StreamObject):
         else:
             print 'Reading text-file 3RDM'
             fname = os.path.join(self.scratchDirectory,"node0", "spatial_threepdm.%d.%d.txt" %(state, state))
-            f = open(fname, 'r')
-            lines = f.readlines()
             E3 = numpy.zeros(shape=(norb, norb, norb, norb, norb, norb), dtype=dt, order='F')
-            for line in lines[1:]:
-                linesp = line.split()
-                if (len(linesp) != 7) :
-                    continue
-                a, b, c, d, e, f, integral = int(linesp[0]), int(linesp[1]), int(linesp[2]), int(linesp[3]), int(linesp[4]), int(linesp[5]), float(linesp[6])
-                E3[a,b,c, f,e,d] = integral
-                E3[a,c,b, f,d,e] = integral
-                E3[b,a,c, e,f,d] = integral
-                E3[b,c,a, e,d,f] = integral
-                E3[c,a,b, d,f,e] = integral
-                E3[c,b,a, d,e,f] = integral
+            with open(fname, 'r') as f:
+                f.readline()
+                idx, integral = _read_pdm_txt(f, 6, skip_irregular=True)
+            # E3[a,b,c, f,e,d] and the 6 permutations of the (a,f), (b,e), (c,d) pairs
+            up_indexes = idx[:3]
+            dn_indexes = idx[:2:-1]
+            for i, j, k in itertools.permutations(range(3)):
+                E3[up_indexes[i],up_indexes[j],up_indexes[k],
+                   dn_indexes[i],dn_indexes[j],dn_indexes[k]] = integral
 
         #for i1 in range(norb):
         #  for i2 in range(norb):
@@ -452,15 +471,19 @@ class DMRGCI(pyscf.lib.StreamObject):
             self.extraline.pop()
 
         # Remove everything
-        os.system("rm -f %s/node0/*twopdm*"%(self.scratchDirectory))
-        os.system("rm -f %s/node0/*tmp"%(self.scratchDirectory))
+        _remove_files(os.path.join(self.scratchDirectory, "node0", "*twopdm*"))
+        _remove_files(os.path.join(self.scratchDirectory, "node0", "*tmp"))
+
+        # Fall back to the text file if Block did not write the binary file
+        fname = os.path.join(self.scratchDirectory,"node0", "spatial_fourpdm.%d.%d.bin" %(state, state))
+        if (filetype == "binary" and not os.path.isfile(fname)):
+            filetype = "text"
 
         # The binary files coming from STACKBLOCK and BLOCK are different:
         # - STACKBLOCK does not have 4RDM
         #   if it had, it's probably gonna come in a 8-fold symmetry, which must unpacked using "libunpack.unpackE4" (see lib/icmpspt/icmpspt.c)
         # - BLOCK just writes a list of all values, this is directly read by "unpackE4_BLOCK"
         if (filetype == "binary") :
-            fname = os.path.join(self.scratchDirectory,"node0", "spatial_fourpdm.%d.%d.bin" %(state, state))
             if 'stackblock' in settings.BLOCKEXE:
               print 'Reading binary 4RDM from STACKBLOCK'
               fnameout = os.path.join(self.scratchDirectory,"node0", "spatial_fourpdm.%d.%d.bin.unpack" %(state, state))
@@ -475,28 +498,16 @@ class DMRGCI(pyscf.lib.StreamObject):
         else:
             print 'Reading text-file 4RDM'
             fname = os.path.join(self.scratchDirectory,"node0", "spatial_fourpdm.%d.%d.txt" %(state, state))
-            f = open(fname, 'r')
-            lines = f.readlines()
             E4 = numpy.zeros(shape=(norb, norb, norb, norb, norb, norb, norb, norb), dtype=dt, order='F')
-            for line in lines[1:]:
-              linesp = line.split()
-              if (len(linesp) != 9) :
-                  continue
-              a, b, c, d, e, f, g, h, integral = int(linesp[0]), int(linesp[1]), int(linesp[2]), int(linesp[3]), int(linesp[4]), int(linesp[5]), int(linesp[6]), int(linesp[7]), float(linesp[8])
-              up_indexes=[a,b,c,d]
-              dn_indexes=[h,g,f,e]
-              for i in range(4):
-                for j in range(4):
-                  if (i==j):
-                    continue
-                  for k in range(4):
-                    if ((i==k)or(j==k)):
-                      continue
-                    for l in range(4):
-                      if ((i==l)or(j==l)or(k==l)):
-                        continue
-                      E4[up_indexes[i],up_indexes[j],up_indexes[k],up_indexes[l],\
-                         dn_indexes[i],dn_indexes[j],dn_indexes[k],dn_indexes[l]] = integral
+            with open(fname, 'r') as f:
+                f.readline()
+                idx, integral = _read_pdm_txt(f, 8, skip_irregular=True)
+            # E4[a,b,c,d, h,g,f,e] and the 24 permutations of the index pairs
+            up_indexes = idx[:4]
+            dn_indexes = idx[:3:-1]
+            for i, j, k, l in itertools.permutations(range(4)):
+                E4[up_indexes[i],up_indexes[j],up_indexes[k],up_indexes[l],
+                   dn_indexes[i],dn_indexes[j],dn_indexes[k],dn_indexes[l]] = integral
         #for i1 in range(norb):
         #  for i2 in range(norb):
         #    for i3 in range(norb):
@@ -511,36 +522,22 @@ class DMRGCI(pyscf.lib.StreamObject):
         return E4
 
     def unpackE3_BLOCK(self,fname,norb):
-        E3=numpy.zeros((norb,norb,norb,norb,norb,norb), order='F')
-        fil=open(fname,"rb")
-        fil.seek(93)
-        for a in range(norb):
-          for b in range(norb):
-            for c in range(norb):
-              for d in range(norb):
-                for e in range(norb):
-                  for f in range(norb):
-                    (value,)=struct.unpack('d',fil.read(8))
-                    E3[a,b,c,  f,e,d]=value
-        fil.close()
-        return E3
+        # The file holds the values of [a,b,c,d,e,f] in C order after a
+        # 93-byte header.  They are stored in E3[a,b,c, f,e,d].
+        with open(fname,"rb") as fil:
+            fil.seek(93)
+            E3 = numpy.fromfile(fil, dtype=numpy.double, count=norb**6)
+        E3 = E3.reshape((norb,)*6).transpose(0,1,2,5,4,3)
+        return numpy.asfortranarray(E3)
 
     def unpackE4_BLOCK(self,fname,norb):
-        E4=numpy.zeros((norb,norb,norb,norb,norb,norb,norb,norb), order='F')
-        fil=open(fname,"rb")
-        fil.seek(109)
-        for a in range(norb):
-          for b in range(norb):
-            for c in range(norb):
-              for d in range(norb):
-                for e in range(norb):
-                  for f in range(norb):
-                    for g in range(norb):
-                      for h in range(norb):
-                        (value,)=struct.unpack('d',fil.read(8))
-                        E4[a,b,c,d,  h,g,f,e]=value
-        fil.close()
-        return E4
+        # [a,b,c,d,e,f,g,h] in C order after a 109-byte header, stored in
+        # E4[a,b,c,d, h,g,f,e]
+        with open(fname,"rb") as fil:
+            fil.seek(109)
+            E4 = numpy.fromfile(fil, dtype=numpy.double, count=norb**8)
+        E4 = E4.reshape((norb,)*8).transpose(0,1,2,3,7,6,5,4)
+        return numpy.asfortranarray(E4)
 
     def clearSchedule(self):
         self.scheduleSweeps = []
@@ -569,10 +566,8 @@ class DMRGCI(pyscf.lib.StreamObject):
             norb_read = int(f.readline().split()[0])
             assert(norb_read == norb)
 
-            for line in f:
-                linesp = line.split()
-                i, j, k, l, m, n = [int(x) for x in linesp[:6]]
-                a16[i,j,k,l,m,n] = float(linesp[6])
+            idx, val = _read_pdm_txt(f, 6)
+            a16[tuple(idx)] = val
 
         return a16
 
@@ -657,6 +652,69 @@ class DMRGCI(pyscf.lib.StreamObject):
             return [ss]*len(civec), [s*2+1]*len(civec)
 
 
+def _remove_files(pattern):
+    '''rm -f pattern, without starting a shell'''
+    for fname in glob.glob(pattern):
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+
+def _read_pdm_txt(f, nidx, skip_irregular=False):
+    '''Read the remaining lines "i j ... value" of a Block text PDM file.
+    Return the indices as an (nidx,nlines) integer array and the values.
+
+    Extra tokens at the end of a line are ignored, and lines of fewer than
+    nidx+1 tokens are skipped.  If skip_irregular is set, lines which do not
+    have exactly nidx+1 tokens are skipped.  ValueError is raised if an index
+    is not an integer.
+    '''
+    ncol = nidx + 1
+    text = f.read()
+    with warnings.catch_warnings():
+        # numpy.fromstring stops at the first bad token with a warning
+        warnings.simplefilter('ignore')
+        try:
+            data = numpy.fromstring(text, sep=' ')
+        except ValueError:
+            data = None
+    # The flat parse is only used if every non-blank line has ncol tokens
+    # and all tokens were parsed.  Otherwise parse line by line.
+    if data is not None and data.size % ncol == 0:
+        ntok_per_line = _count_tokens_per_line(text)
+        if (data.size != ntok_per_line.sum() or
+            numpy.any((ntok_per_line != 0) & (ntok_per_line != ncol))):
+            data = None
+    else:
+        data = None
+    if data is None:
+        rows = [line.split() for line in text.splitlines()]
+        if skip_irregular:
+            rows = [x for x in rows if len(x) == ncol]
+        else:
+            rows = [x[:ncol] for x in rows if len(x) >= ncol]
+        data = numpy.array(rows, dtype=float)
+    data = data.reshape(-1,ncol)
+    idx = data[:,:nidx]
+    if not numpy.all(idx == numpy.rint(idx)):
+        raise ValueError('Non-integer index in PDM file %s' %
+                         getattr(f, 'name', ''))
+    return idx.astype(int).T, data[:,nidx]
+
+def _count_tokens_per_line(text):
+    '''The number of whitespace separated tokens on each line of text'''
+    if not isinstance(text, bytes):
+        text = text.encode('ascii', 'replace')
+    c = numpy.frombuffer(text, dtype=numpy.uint8)
+    if c.size == 0:
+        return numpy.zeros(0, dtype=int)
+    newline = c == ord('\n')
+    space = newline | (c == ord(' ')) | (c == ord('\t')) | (c == ord('\r'))
+    start = ~space
+    start[1:] &= space[:-1]
+    line_id = numpy.cumsum(newline)
+    return numpy.bincount(line_id[start], minlength=line_id[-1]+1)
+
 def make_schedule(sweeps, Ms, tols, noises, twodot_to_onedot):
     if len(sweeps) == len(Ms) == len(tols) == len(noises):
         schedule = ['schedule']
@@ -788,6 +846,8 @@ def executeBLOCK(DMRGCI):
 
     inFile  = DMRGCI.configFile
     outFile = DMRGCI.outputFile
+    # Block overwrites the PDM files
+    DMRGCI._twopdm_cache = {}
     try:
         cmd = ' '.join((DMRGCI.mpiprefix, DMRGCI.executable, inFile))
         cmd = "%s > %s 2>&1" % (cmd, outFile)
@@ -844,7 +904,24 @@ def dryrun(mc, mo_coeff=None):
     mc.casci(mo_coeff)
     mc.fcisolver.onlywriteIntegral = bak
 
+# Block versions of the executables, see block_version
+_block_versions = {}
+
 def block_version(blockexe):
+    '''Version string of the Block executable blockexe.  writeDMRGConfFile
+    asks before every Block run.  The answer is kept for each executable
+    path and modification time, so Block is only run again for the query
+    after the executable is replaced.
+    '''
+    try:
+        key = (blockexe, os.path.getmtime(blockexe))
+    except OSError:  # not a path, e.g. a command found in PATH
+        return _block_version(blockexe)
+    if key not in _block_versions:
+        _block_versions[key] = _block_version(blockexe)
+    return _block_versions[key]
+
+def _block_version(blockexe):
     try:
         msg = check_output([blockexe, '-v'], stderr=STDOUT)
         version = '1.1.0'
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import unittest
+import tempfile
+import numpy
+from pyscf import gto
+from pyscf import dmrgscf
+from pyscf.dmrgscf import dmrgci
+
+mol = gto.M(atom='H 0 0 0; H 0 0 .74', verbose=0)
+
+def read_pdm_txt(text, nidx, **kwargs):
+    with tempfile.NamedTemporaryFile(mode='w') as f:
+        f.write(text)
+        f.flush()
+        with open(f.name, 'r') as fin:
+            return dmrgci._read_pdm_txt(fin, nidx, **kwargs)
+
+class KnowValues(unittest.TestCase):
+    def test_make_dm123(self):
+        norb = 4
+        numpy.random.seed(1)
+        dm1 = numpy.random.random((norb,)*2)
+        dm2 = numpy.random.random((norb,)*4)
+        dm3 = numpy.random.random((norb,)*6)
+        mc = dmrgscf.DMRGCI(mol)
+        mc.make_rdm123 = lambda *args, **kwargs: (dm1, dm2, dm3)
+        dm1a, dm2a, dm3a = mc._make_dm123(0, norb, (1,1))
+
+        I = numpy.eye(norb)
+        ref3 = (numpy.einsum('mkijln->ijklmn', dm3)
+                + numpy.einsum('jk,lm,in->ijklmn', I, I, dm1)
+                + numpy.einsum('jk,miln->ijklmn', I, dm2)
+                + numpy.einsum('lm,kijn->ijklmn', I, dm2)
+                + numpy.einsum('jm,kinl->ijklmn', I, dm2))
+        ref2 = (numpy.einsum('iklj->ijkl', dm2)
+                + numpy.einsum('il,jk->ijkl', dm1, I))
+        self.assertTrue(numpy.allclose(dm1a, dm1))
+        self.assertTrue(numpy.allclose(dm2a, ref2))
+        self.assertTrue(numpy.allclose(dm3a, ref3))
+
+    def test_unpack_block(self):
+        norb = 2
+        numpy.random.seed(2)
+        mc = dmrgscf.DMRGCI(mol)
+        for nidx, header in ((6, 93), (8, 109)):
+            data = numpy.random.random(norb**nidx)
+            with tempfile.NamedTemporaryFile() as f:
+                f.write(b'\0' * header)
+                f.flush()
+                data.tofile(f)
+                f.flush()
+                if nidx == 6:
+                    e = mc.unpackE3_BLOCK(f.name, norb)
+                else:
+                    e = mc.unpackE4_BLOCK(f.name, norb)
+            # values of [a,b,c,...] are stored in [a,b,c,..., ...,c,b,a] with
+            # the second half of the indices reversed
+            ref = numpy.zeros((norb,)*nidx)
+            half = nidx // 2
+            for n, idx in enumerate(numpy.ndindex(*ref.shape)):
+                ref[idx[:half] + idx[half:][::-1]] = data[n]
+            self.assertTrue(e.flags.f_contiguous)
+            self.assertTrue(numpy.array_equal(e, ref))
+
+    def test_read_pdm_txt(self):
+        idx, val = read_pdm_txt('0 1 .5\n1 0 -.25\n', 2)
+        self.assertTrue(numpy.array_equal(idx, [[0, 1], [1, 0]]))
+        self.assertTrue(numpy.array_equal(val, [.5, -.25]))
+        # blank lines and CRLF line endings
+        idx, val = read_pdm_txt('0 1 .5\r\n\r\n1 0 -.25\r\n\n', 2)
+        self.assertTrue(numpy.array_equal(idx, [[0, 1], [1, 0]]))
+        self.assertTrue(numpy.array_equal(val, [.5, -.25]))
+        # extra tokens are ignored, short lines are skipped
+        idx, val = read_pdm_txt('0 1 .5 9\n1\n1 0 -.25\n', 2)
+        self.assertTrue(numpy.array_equal(idx, [[0, 1], [1, 0]]))
+        self.assertTrue(numpy.array_equal(val, [.5, -.25]))
+        # irregular lines are skipped altogether
+        idx, val = read_pdm_txt('0 1 .5 9\n1 1\n1 0 -.25\n', 2,
+                                skip_irregular=True)
+        self.assertTrue(numpy.array_equal(idx, [[1], [0]]))
+        self.assertTrue(numpy.array_equal(val, [-.25]))
+        self.assertRaises(ValueError, read_pdm_txt, '2 0.1 0 0 0\n', 4)
+        self.assertRaises(ValueError, read_pdm_txt, '2 0.1 0 0 0 9\n', 4)
+
+if __name__ == "__main__":
+    print("Full Tests for DMRGCI density matrices")
+    unittest.main()
@@ -70,7 +70,7 @@ def ft_aopair(mol, Gv, shls_slice=None, aosym='s1', b=numpy.eye(3),
     mat = numpy.ndarray(shape, order='F', dtype=numpy.complex128, buffer=buf)
 
     fn(intor, eval_gz, fill, mat.ctypes.data_as(ctypes.c_void_p),
-       (ctypes.c_int*4)(*shls_slice),
+       lib.c_int4(*shls_slice),
        ao_loc.ctypes.data_as(ctypes.c_void_p), ctypes.c_double(0),
        GvT.ctypes.data_as(ctypes.c_void_p),
        p_b, p_gxyzT, p_gs, ctypes.c_int(nGv),
@@ -128,7 +128,7 @@ def ft_ao(mol, Gv, shls_slice=None, b=numpy.eye(3),
 
     shls_slice = shls_slice + (mol.nbas, mol.nbas+1)
     fn(intor, eval_gz, fill, mat.ctypes.data_as(ctypes.c_void_p),
-       (ctypes.c_int*4)(*shls_slice),
+       lib.c_int4(*shls_slice),
        ao_loc.ctypes.data_as(ctypes.c_void_p),
        ctypes.c_double(0),
        GvT.ctypes.data_as(ctypes.c_void_p),
@@ -243,7 +243,7 @@ def getints2c(intor_name, atm, bas, env, shls_slice=None, comp=1, hermi=0,
     fn = getattr(libcgto, drv_name)
     fn(getattr(libcgto, intor_name), mat.ctypes.data_as(ctypes.c_void_p),
        ctypes.c_int(comp), ctypes.c_int(hermi),
-       (ctypes.c_int*4)(*(shls_slice[:4])),
+       lib.c_int4(*(shls_slice[:4])),
        ao_loc.ctypes.data_as(ctypes.c_void_p), cintopt,
        atm.ctypes.data_as(ctypes.c_void_p), ctypes.c_int(natm),
        bas.ctypes.data_as(ctypes.c_void_p), ctypes.c_int(nbas),
@@ -302,7 +302,7 @@ def getints3c(intor_name, atm, bas, env, shls_slice=None, comp=1,
 
     drv(getattr(libcgto, intor_name), fill,
         mat.ctypes.data_as(ctypes.c_void_p), ctypes.c_int(comp),
-        (ctypes.c_int*6)(*(shls_slice[:6])),
+        lib.c_int6(*(shls_slice[:6])),
         ao_loc.ctypes.data_as(ctypes.c_void_p), cintopt,
         atm.ctypes.data_as(ctypes.c_void_p), ctypes.c_int(natm),
         bas.ctypes.data_as(ctypes.c_void_p), ctypes.c_int(nbas),
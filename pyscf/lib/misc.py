@@ -13,7 +13,11 @@ import shutil
 import functools
 import itertools
 import math
+import operator
+import collections
 import ctypes
+import mmap
+import weakref
 import numpy
 import h5py
 from pyscf.lib import param
@@ -22,66 +26,109 @@ c_double_p = ctypes.POINTER(ctypes.c_double)
 c_int_p = ctypes.POINTER(ctypes.c_int)
 c_null_ptr = ctypes.POINTER(ctypes.c_void_p)
 
+# The chunk cache of h5py.File can be configured since h5py 2.9
+_H5PY_RDCC = tuple(int(x) for x in h5py.version.version.split('.')[:2]) >= (2, 9)
+
+_LOADED_LIBRARIES = {}
 def load_library(libname):
-# numpy 1.6 has bug in ctypeslib.load_library, see numpy/distutils/misc_util.py
-    if '1.6' in numpy.__version__:
-        if (sys.platform.startswith('linux') or
-            sys.platform.startswith('gnukfreebsd')):
-            so_ext = '.so'
-        elif sys.platform.startswith('darwin'):
-            so_ext = '.dylib'
-        elif sys.platform.startswith('win'):
-            so_ext = '.dll'
-        else:
-            raise OSError('Unknown platform')
-        libname_so = libname + so_ext
-        return ctypes.CDLL(os.path.join(os.path.dirname(__file__), libname_so))
-    else:
+    '''Load the shared library in pyscf/lib.  Each library is loaded only
+    once and cached.
+    '''
+    if libname not in _LOADED_LIBRARIES:
         _loaderpath = os.path.dirname(__file__)
-        return numpy.ctypeslib.load_library(libname, _loaderpath)
+        _LOADED_LIBRARIES[libname] = \
+                numpy.ctypeslib.load_library(libname, _loaderpath)
+    return _LOADED_LIBRARIES[libname]
 
 #Fixme, the standard resouce module gives wrong number when objects are released
 #see http://fa.bianp.net/blog/2013/different-ways-to-get-memory-consumption-or-lessons-learned-from-memory_profiler/#fn:1
 #or use slow functions as memory_profiler._get_memory did
 CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
 PAGESIZE = os.sysconf("SC_PAGE_SIZE")
+_STATM = [None, None]  # [pid, fd of /proc/pid/statm]
 def current_memory():
     #import resource
     #return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000
     if sys.platform.startswith('linux'):
-        with open("/proc/%s/statm" % os.getpid()) as f:
-            vms, rss = [int(x)*PAGESIZE for x in f.readline().split()[:2]]
-            return rss/1e6, vms/1e6
+        pid = os.getpid()
+        if _STATM[0] != pid:  # reopen in the child process after fork
+            _STATM[:] = pid, os.open('/proc/%s/statm' % pid, os.O_RDONLY)
+        fd = _STATM[1]
+        os.lseek(fd, 0, os.SEEK_SET)
+        vms, rss = [int(x)*PAGESIZE for x in os.read(fd, 128).split()[:2]]
+        return rss/1e6, vms/1e6
     else:
         return 0, 0
 
-def num_threads():
-    if 'OMP_NUM_THREADS' in os.environ:
-        return int(os.environ['OMP_NUM_THREADS'])
-    else:
-        import multiprocessing
-        return multiprocessing.cpu_count()
+_NUM_THREADS = None
+def num_threads(n=None):
+    '''Get the number of OpenMP threads.  If n is given, set the number of
+    OpenMP threads for the C libraries to n.
+
+    The thread count is looked up at the first call and cached (note
+    pyscf.pbc.tools calls num_threads at import).  Later changes of
+    OMP_NUM_THREADS or of the CPU affinity mask are not seen, the same as the
+    OpenMP runtime which reads OMP_NUM_THREADS only once.  Call
+    num_threads(n) to change it.  num_threads(n) calls omp_set_num_threads,
+    which changes the thread count of all pyscf C libraries in this process.
+    '''
+    global _NUM_THREADS
+    if n is not None:
+        try:
+            _libomp().omp_set_num_threads(ctypes.c_int(n))
+        except (OSError, AttributeError):  # library not compiled with OpenMP
+            pass
+        _NUM_THREADS = int(n)
+    elif _NUM_THREADS is None:
+        try:
+            _libomp().omp_get_max_threads.restype = ctypes.c_int
+            _NUM_THREADS = _libomp().omp_get_max_threads()
+        except (OSError, AttributeError):
+            if 'OMP_NUM_THREADS' in os.environ:
+                _NUM_THREADS = int(os.environ['OMP_NUM_THREADS'])
+            elif hasattr(os, 'sched_getaffinity'):
+                # The CPUs available to this process (restricted by the
+                # job scheduler or cgroups)
+                _NUM_THREADS = len(os.sched_getaffinity(0))
+            else:
+                import multiprocessing
+                _NUM_THREADS = multiprocessing.cpu_count()
+    return _NUM_THREADS
+
+def _libomp():
+    # libnp_helper is linked against the OpenMP runtime which is shared by
+    # all pyscf C libraries
+    return load_library('libnp_helper')
 
 
 def c_int_arr(m):
-    npm = numpy.array(m).flatten('C')
-    arr = (ctypes.c_int * npm.size)(*npm)
-    # cannot return LP_c_double class,
-    #Xreturn npm.ctypes.data_as(c_int_p), which destructs npm before return
+    npm = numpy.ascontiguousarray(m, dtype=numpy.intc).ravel()
+    arr = npm.ctypes.data_as(c_int_p)
+    # npm.ctypes.data_as(c_int_p) does not hold a reference to npm. Attach npm
+    # to the pointer so that the buffer is not destructed before return
+    arr._keep = npm
     return arr
 def f_int_arr(m):
-    npm = numpy.array(m).flatten('F')
-    arr = (ctypes.c_int * npm.size)(*npm)
+    npm = numpy.asarray(m, dtype=numpy.intc).ravel('F')
+    arr = npm.ctypes.data_as(c_int_p)
+    arr._keep = npm
     return arr
 def c_double_arr(m):
-    npm = numpy.array(m).flatten('C')
-    arr = (ctypes.c_double * npm.size)(*npm)
+    npm = numpy.ascontiguousarray(m, dtype=numpy.double).ravel()
+    arr = npm.ctypes.data_as(c_double_p)
+    arr._keep = npm
     return arr
 def f_double_arr(m):
-    npm = numpy.array(m).flatten('F')
-    arr = (ctypes.c_double * npm.size)(*npm)
+    npm = numpy.asarray(m, dtype=numpy.double).ravel('F')
+    arr = npm.ctypes.data_as(c_double_p)
+    arr._keep = npm
     return arr
 
+# For the small fixed-size arguments (eg shls_slice), build the ctypes array
+# directly.  It is much cheaper than going through numpy in c_int_arr.
+c_int4 = ctypes.c_int * 4
+c_int6 = ctypes.c_int * 6
+
 
 def member(test, x, lst):
     for l in lst:
@@ -89,34 +136,99 @@ def member(test, x, lst):
             return True
     return False
 
-def remove_dup(test, lst, from_end=False):
-    if test is None:
+def remove_dup(test, lst, from_end=False, key=None):
+    '''Remove the duplicated elements.  Two elements are identical if
+    test(x, y) is True.  If key is given, elements are identical if their
+    keys (which need to be hashable) are equal, and test is ignored.
+    '''
+    if key is not None:
+        if from_end:
+            lst = reversed(lst)
+        seen = set()
+        uniq = []
+        for l in lst:
+            k = key(l)
+            if k not in seen:
+                seen.add(k)
+                uniq.append(l)
+        return uniq
+    elif test is None:
         return set(lst)
     else:
         if from_end:
-            lst = list(reversed(lst))
+            lst = reversed(lst)
+        if test is operator.eq:
+            lst = list(lst)
+            try:
+                # hashable elements: keep the first occurrence in O(N)
+                return list(collections.OrderedDict.fromkeys(lst))
+            except TypeError:
+                pass
         seen = []
+        append = seen.append
         for l in lst:
-            if not member(test, l, seen):
-                seen.append(l)
+            for x in seen:
+                if test(l, x):
+                    break
+            else:
+                append(l)
         return seen
 
 def remove_if(test, lst):
     return [x for x in lst if not test(x)]
 
-def find_if(test, lst):
+def find_if(test, lst, vectorized=False):
+    '''The first element of lst which satisfies test.  If vectorized is
+    set and lst is a 1D numpy array, test is applied to the whole array and
+    needs to return a boolean array (e.g. lambda x: x > 0).
+    '''
+    if vectorized:
+        i = _arg_first_match_1darray(test, lst)
+        if i is not None:
+            return lst[i]
     for l in lst:
         if test(l):
             return l
     raise ValueError('No element of the given list matches the test condition.')
 
-def arg_first_match(test, lst):
+def arg_first_match(test, lst, vectorized=False):
+    '''The index of the first element of lst which satisfies test.  See
+    :func:`find_if` for vectorized.
+    '''
+    if vectorized:
+        i = _arg_first_match_1darray(test, lst)
+        if i is not None:
+            return i
     for i,x in enumerate(lst):
         if test(x):
             return i
     raise ValueError('No element of the given list matches the test condition.')
 
+def _arg_first_match_1darray(test, lst):
+    '''For 1D numpy array and elementwise test (e.g. lambda x: x > 0), apply
+    test on the entire array.  Returns None if lst is not a 1D array or test
+    does not return a boolean mask.
+    '''
+    if not (isinstance(lst, numpy.ndarray) and lst.ndim == 1):
+        return None
+    mask = test(lst)
+    if (isinstance(mask, numpy.ndarray) and mask.dtype == numpy.bool_ and
+        mask.shape == lst.shape):
+        i = int(mask.argmax())
+        if mask[i]:
+            return i
+        raise ValueError('No element of the given list matches the test condition.')
+    return None
+
 def tril_equal_pace(n, base=0, npace=0, minimal=1):
+    p0s, p1s = tril_equal_pace_arr(n, base, npace, minimal)
+    for p0, p1 in zip(p0s, p1s):
+        yield p0, p1
+
+def tril_equal_pace_arr(n, base=0, npace=0, minimal=1):
+    '''The (p0, p1) segments of tril_equal_pace as two numpy arrays, so that
+    all segments can be passed to C code in one call.
+    '''
     idx = numpy.arange(n+1)
     cum = idx * (idx+1) // 2
     if base == 0:
@@ -127,23 +239,34 @@ def tril_equal_pace(n, base=0, npace=0, minimal=1):
             displs = _balanced_partition(cum, npace)
     else:
         displs = _blocksize_partition(cum, base)
-    for p0, p1 in zip(displs[:-1], displs[1:]):
-        yield p0, p1
+    displs = numpy.asarray(displs)
+    return displs[:-1], displs[1:]
 
 def _balanced_partition(cum, ntasks):
     segsize = float(cum[-1]) / ntasks
     bounds = numpy.arange(ntasks+1) * segsize
-    displs = abs(bounds[:,None] - cum).argmin(axis=1)
+# cum is monotonic. The nearest element to each bound is either the one found
+# by the binary search or its left neighbour.
+    idx = numpy.searchsorted(cum, bounds).clip(1, len(cum)-1)
+    left = cum[idx-1]
+    right = cum[idx]
+    displs = numpy.where(bounds-left <= right-bounds, idx-1, idx)
     return displs
 
 def _blocksize_partition(cum, blocksize):
     n = len(cum) - 1
     displs = [0]
     p0 = 0
-    for i in range(1, n):
-        if cum[i+1]-cum[p0] > blocksize:
-            displs.append(i)
-            p0 = i
+# The block starting from p0 ends at the first i (i > p0) which satisfies
+# cum[i+1]-cum[p0] > blocksize.  Search it in the monotonic cum array then
+# the loop runs over blocks rather than over the elements.
+    while True:
+        i = max(int(numpy.searchsorted(cum, cum[p0]+blocksize, side='right')),
+                p0+2) - 1
+        if i >= n:
+            break
+        displs.append(i)
+        p0 = i
     displs.append(n)
     return displs
 
@@ -156,12 +279,75 @@ def flatten(lst):
     >>> flatten([[0, 2], [1], [[9, 8, 7]]])
     [0, 2, 1, [9, 8, 7]]
     '''
+    if (isinstance(lst, (list, tuple)) and len(lst) > 0 and
+        all(isinstance(x, numpy.ndarray) and x.ndim == 1 and
+            x.dtype == lst[0].dtype for x in lst)):
+        # Join 1D arrays of one dtype in one memcpy.  The elements are numpy
+        # scalars, the same to what itertools.chain produces for numpy arrays.
+        # Arrays of different dtypes would be cast to a common type.
+        return list(numpy.concatenate(lst))
     return list(itertools.chain.from_iterable(lst))
 
+def flatten_deep(lst, types=(list, tuple)):
+    '''flatten nested lists recursively.  The elements of the given types
+    are expanded.  Iterates with an explicit stack, so there is no limit on
+    the nesting depth.
+
+    Examples:
+
+    >>> flatten_deep([[0, 2], [1], [[9, (8, 7)]]])
+    [0, 2, 1, 9, 8, 7]
+    '''
+    out = []
+    stack = [iter(lst)]
+    while stack:
+        for x in stack[-1]:
+            if isinstance(x, types):
+                stack.append(iter(x))
+                break
+            else:
+                out.append(x)
+        else:
+            stack.pop()
+    return out
+
 def prange(start, end, step):
     for i in range(start, end, step):
         yield i, min(i+step, end)
 
+def prange_split(start, end, step):
+    '''The (start, end) pairs of prange as two numpy arrays
+
+    Examples:
+
+    >>> prange_split(0, 10, 4)
+    (array([0, 4, 8]), array([ 4,  8, 10]))
+    '''
+    starts = numpy.arange(start, end, step)
+    return starts, numpy.minimum(starts+step, end)
+
+
+def _stdout_tmpfile():
+    '''An in-memory file to hold the redirected stdout.  Returns the file
+    descriptor and the file name (None for anonymous memfd file).
+    '''
+    if hasattr(os, 'memfd_create'):
+        return os.memfd_create('pyscf_stdout'), None
+    else:
+        return tempfile.mkstemp(dir='/dev/shm')
+
+def _read_stdout_tmpfile(fd):
+    size = os.fstat(fd).st_size
+    if size == 0:
+        return ''
+    buf = mmap.mmap(fd, size, prot=mmap.PROT_READ)
+    try:
+        contents = buf[:]
+    finally:
+        buf.close()
+    if not isinstance(contents, str):
+        contents = contents.decode()
+    return contents
 
 class ctypes_stdout(object):
     '''make c-printf output to string, but keep python print in /dev/pts/1.
@@ -176,26 +362,25 @@ class ctypes_stdout(object):
         self.old_stdout_fileno = sys.stdout.fileno()
         self.bak_stdout_fd = os.dup(self.old_stdout_fileno)
         self.bak_stdout = sys.stdout
-        self.fd, self.ftmp = tempfile.mkstemp(dir='/dev/shm')
+        self.fd, self.ftmp = _stdout_tmpfile()
         os.dup2(self.fd, self.old_stdout_fileno)
         sys.stdout = os.fdopen(self.bak_stdout_fd, 'w')
         return self
     def __exit__(self, type, value, traceback):
         sys.stdout.flush()
         os.fsync(self.fd)
-        self._contents = open(self.ftmp, 'r').read()
+        self._contents = _read_stdout_tmpfile(self.fd)
         os.dup2(self.bak_stdout_fd, self.old_stdout_fileno)
         sys.stdout = self.bak_stdout # self.bak_stdout_fd is closed
-        #os.close(self.fd) is closed when os.fdopen is closed
-        os.remove(self.ftmp)
+        os.close(self.fd)
+        if self.ftmp is not None:
+            os.remove(self.ftmp)
     def read(self):
-        if self._contents:
+        if self._contents is not None:
             return self._contents
         else:
             sys.stdout.flush()
-            #f = os.fdopen(self.fd, 'r') # need to rewind(0) before reading
-            #f.seek(0)
-            return open(self.ftmp, 'r').read()
+            return _read_stdout_tmpfile(self.fd)
 
 class capture_stdout(object):
     '''redirect all stdout (c printf & python print) into a string
@@ -209,48 +394,67 @@ class capture_stdout(object):
         self._contents = None
         self.old_stdout_fileno = sys.stdout.fileno()
         self.bak_stdout_fd = os.dup(self.old_stdout_fileno)
-        self.fd, self.ftmp = tempfile.mkstemp(dir='/dev/shm')
+        self.fd, self.ftmp = _stdout_tmpfile()
         os.dup2(self.fd, self.old_stdout_fileno)
         return self
     def __exit__(self, type, value, traceback):
         sys.stdout.flush()
-        self._contents = open(self.ftmp, 'r').read()
+        self._contents = _read_stdout_tmpfile(self.fd)
         os.dup2(self.bak_stdout_fd, self.old_stdout_fileno)
         os.close(self.bak_stdout_fd)
-        #os.close(self.fd) will be closed when os.fdopen is closed
-        os.remove(self.ftmp)
+        os.close(self.fd)
+        if self.ftmp is not None:
+            os.remove(self.ftmp)
     def read(self):
-        if self._contents:
+        if self._contents is not None:
             return self._contents
         else:
             sys.stdout.flush()
-            #f = os.fdopen(self.fd, 'r') # need to rewind(0) before reading
-            #f.seek(0)
-            return open(self.ftmp, 'r').read()
+            return _read_stdout_tmpfile(self.fd)
 
+_DEVNULL = None
 class quite_run(object):
     '''output nothing
 
+    By default, only the Python output (sys.stdout) is suppressed.  With
+    c_stdout=True, the output of the C libraries and the files written to
+    the current directory are discarded as well.  This needs to redirect the
+    file descriptor and to switch the working directory, which is more
+    expensive.
+
     Examples
     --------
     with quite_run():
         ...
     '''
+    def __init__(self, c_stdout=False):
+        self.c_stdout = c_stdout
     def __enter__(self):
+        global _DEVNULL
         sys.stdout.flush()
-        self.dirnow = os.getcwd()
-        self.tmpdir = tempfile.mkdtemp(dir='/dev/shm')
-        os.chdir(self.tmpdir)
-        self.old_stdout_fileno = sys.stdout.fileno()
-        self.bak_stdout_fd = os.dup(self.old_stdout_fileno)
-        self.fnull = open(os.devnull, 'wb')
-        os.dup2(self.fnull.fileno(), self.old_stdout_fileno)
+        if self.c_stdout:
+            self.dirnow = os.getcwd()
+            self.tmpdir = tempfile.mkdtemp(dir='/dev/shm')
+            os.chdir(self.tmpdir)
+            self.old_stdout_fileno = sys.stdout.fileno()
+            self.bak_stdout_fd = os.dup(self.old_stdout_fileno)
+            self.fnull = open(os.devnull, 'wb')
+            os.dup2(self.fnull.fileno(), self.old_stdout_fileno)
+        else:
+            if _DEVNULL is None:
+                _DEVNULL = open(os.devnull, 'w')
+            self.bak_stdout = sys.stdout
+            sys.stdout = _DEVNULL
     def __exit__(self, type, value, traceback):
         sys.stdout.flush()
-        os.dup2(self.bak_stdout_fd, self.old_stdout_fileno)
-        self.fnull.close()
-        shutil.rmtree(self.tmpdir)
-        os.chdir(self.dirnow)
+        if self.c_stdout:
+            os.dup2(self.bak_stdout_fd, self.old_stdout_fileno)
+            os.close(self.bak_stdout_fd)
+            self.fnull.close()
+            shutil.rmtree(self.tmpdir)
+            os.chdir(self.dirnow)
+        else:
+            sys.stdout = self.bak_stdout
 
 
 # from pygeocoder
@@ -333,15 +537,25 @@ class StreamObject(object):
         return self
 
 _warn_once_registry = {}
+# dir(cls) is expensive.  Cache the class attributes for each class.  Weak
+# references allow the classes generated on the fly to be released.
+_class_attr_cache = weakref.WeakKeyDictionary()
+def _class_attrs(cls):
+    try:
+        return _class_attr_cache[cls]
+    except KeyError:
+        attrs = _class_attr_cache[cls] = frozenset(dir(cls))
+        return attrs
+
 def check_sanity(obj, keysref, stdout=sys.stdout):
     '''Check misinput of class attributes, check whether a class method is
     overwritten.  It does not check the attributes which are prefixed with
     "_".
     '''
     objkeys = [x for x in obj.__dict__ if not x.startswith('_')]
-    keysub = set(objkeys) - set(keysref)
+    keysub = set(objkeys).difference(keysref)
     if keysub:
-        class_attr = set(dir(obj.__class__))
+        class_attr = _class_attrs(obj.__class__)
         keyin = keysub.intersection(class_attr)
         if keyin:
             msg = ('Overwrite attributes  %s  of %s\n' %
@@ -421,13 +635,21 @@ class ProcessWithReturnValue(Process):
 class ThreadWithReturnValue(Thread):
     def __init__(self, group=None, target=None, name=None, args=(),
                  kwargs=None):
-        self._q = Queue()
+        # Threads share memory. The return value does not need to go through
+        # the pipe and pickle of multiprocessing.Queue
+        self._result = None
+        self._e = None
         def qwrap(*args, **kwargs):
-            self._q.put(target(*args, **kwargs))
+            try:
+                self._result = target(*args, **kwargs)
+            except BaseException as e:
+                self._e = e
         Thread.__init__(self, group, qwrap, name, args, kwargs)
     def join(self):
         Thread.join(self)
-        return self._q.get()
+        if self._e is not None:
+            raise self._e
+        return self._result
     get = join
 
 def background_thread(func, *args, **kwargs):
@@ -447,14 +669,74 @@ bp = bg_process = background_process
 
 
 class H5TmpFile(h5py.File):
+    '''HDF5 file for temporary data.
+
+    Kwargs:
+        compression : str
+            Default compression filter (eg 'lzf') for the datasets created by
+            :func:`create_dataset` in the root group.  It does not apply to
+            the datasets of subgroups (f.create_group(...).create_dataset),
+            which need the compression keyword explicitly.  Compression
+            requires chunked storage.
+    '''
     def __init__(self, filename=None, *args, **kwargs):
         if filename is None:
             tmpfile = tempfile.NamedTemporaryFile(dir=param.TMPDIR)
             filename = tmpfile.name
+        compression = kwargs.pop('compression', None)
+        # The temporary files are not read by other programs. The latest file
+        # format is more efficient for large datasets.
+        kwargs.setdefault('libver', 'latest')
+        if _H5PY_RDCC:
+            kwargs.setdefault('rdcc_nbytes', param.H5_CHUNK_CACHE_SIZE)
         h5py.File.__init__(self, filename, *args, **kwargs)
+        self._compression = compression
+    def create_dataset(self, name, *args, **kwargs):
+        if self._compression is not None:
+            kwargs.setdefault('compression', self._compression)
+            kwargs.setdefault('chunks', True)
+        return h5py.File.create_dataset(self, name, *args, **kwargs)
     def __del__(self):
         self.close()
 
+class H5CoreTmpFile(H5TmpFile):
+    '''H5TmpFile held in memory (HDF5 core driver).  It is suitable for the
+    intermediates which are small enough to fit in memory and are written
+    then read once.
+
+    Kwargs:
+        backing_store : bool
+            Whether to write the data to the file when the file is closed.
+            By default, the data are only saved if filename is given.
+        block_size : int
+            Increment (in bytes) to grow the memory buffer.
+    '''
+    def __init__(self, filename=None, *args, **kwargs):
+        kwargs.setdefault('driver', 'core')
+        kwargs.setdefault('backing_store', filename is not None)
+        kwargs.setdefault('block_size', 64*1024**2)
+        H5TmpFile.__init__(self, filename, *args, **kwargs)
+
+def as_memmap(dset, mode='r'):
+    '''Map the data of a HDF5 dataset to numpy.memmap.  The returned array
+    reads/writes the file directly without loading the dataset in memory.
+    Only the contiguous datasets (not chunked, not compressed) can be mapped.
+    '''
+    if dset.chunks is not None or dset.compression is not None:
+        raise ValueError('Dataset %s is chunked or compressed' % dset.name)
+    if dset.file.driver != 'sec2':
+        raise ValueError('Cannot map dataset of HDF5 driver %s' % dset.file.driver)
+    dset.file.flush()
+    offset = dset.id.get_offset()
+    if offset is None:  # storage not allocated
+        raise ValueError('Dataset %s has no data' % dset.name)
+    # H5TmpFile is unlinked from the file system. Map the opened file
+    # descriptor rather than the file name.
+    fd = os.dup(dset.file.id.get_vfd_handle())
+    with os.fdopen(fd, 'rb' if mode == 'r' else 'r+b') as f:
+        return numpy.memmap(f, dtype=dset.dtype, mode=mode,
+                            offset=offset, shape=dset.shape)
+
 def finger(a):
     return numpy.dot(numpy.cos(numpy.arange(a.size)), a.ravel())
 
@@ -7,6 +7,9 @@ L_MAX      = 8
 MAX_MEMORY = int(os.environ.get('PYSCF_MAX_MEMORY', 4000)) # MB
 TMPDIR = os.environ.get('TMPDIR', '.')
 TMPDIR = os.environ.get('PYSCF_TMPDIR', TMPDIR)
+# Size of the HDF5 chunk cache of the temporary files (lib.H5TmpFile).  HDF5
+# allocates a cache of this size for every opened chunked dataset.
+H5_CHUNK_CACHE_SIZE = int(os.environ.get('PYSCF_H5_CHUNK_CACHE_SIZE', 1<<24)) # bytes
 
 LIGHT_SPEED = 137.03599967994  #http://physics.nist.gov/cgi-bin/cuu/Value?alph
 #LIGHT_SPEED = 137.0359895
@@ -0,0 +1,104 @@
+#
+# Author: Qiming Sun <osirpt.sun@gmail.com>
+#
+
+import unittest
+import tempfile
+import numpy
+import h5py
+from pyscf import lib
+
+class KnowValues(unittest.TestCase):
+    def test_find_if(self):
+        a = numpy.array([-1.5, 2.5, 3., 4.5])
+        self.assertEqual(lib.find_if(lambda x: x > 0, a), 2.5)
+        self.assertEqual(lib.arg_first_match(lambda x: x > 0, a), 1)
+        # element-wise tests which do not work on arrays
+        self.assertEqual(lib.find_if(lambda x: x.is_integer(), a), 3.)
+        self.assertEqual(lib.arg_first_match(lambda x: x.is_integer(), a), 2)
+        self.assertEqual(lib.arg_first_match(lambda x: x > 0, [-1, 0, 2]), 2)
+        self.assertRaises(ValueError, lib.find_if, lambda x: x > 5, a)
+
+    def test_find_if_vectorized(self):
+        a = numpy.array([-1., 2.5, 3., 4.5])
+        self.assertEqual(lib.find_if(lambda x: x > 3, a, vectorized=True), 4.5)
+        self.assertEqual(lib.arg_first_match(lambda x: x > 3, a, vectorized=True), 3)
+        self.assertRaises(ValueError, lib.arg_first_match, lambda x: x > 5, a,
+                          vectorized=True)
+        # test does not return a mask
+        self.assertEqual(lib.arg_first_match(lambda x: numpy.sum(x) > 0,
+                                             numpy.array([-1., 2.]),
+                                             vectorized=True), 1)
+        # multi-dimensional arrays are tested row by row
+        b = numpy.array([[0, 0], [0, 1]])
+        self.assertEqual(lib.arg_first_match(lambda x: x.any(), b,
+                                             vectorized=True), 1)
+
+    def test_flatten(self):
+        self.assertEqual(lib.flatten([[0, 2], [1], [[9, 8, 7]]]),
+                         [0, 2, 1, [9, 8, 7]])
+        a = lib.flatten([numpy.arange(3), numpy.arange(2)])
+        self.assertEqual(a, [0, 1, 2, 0, 1])
+        # Arrays of different dtypes keep their element types
+        a = lib.flatten([numpy.array([1, 2]), numpy.array([.5])])
+        self.assertEqual(a, [1, 2, .5])
+        self.assertTrue(isinstance(a[0], numpy.integer))
+        self.assertTrue(isinstance(a[2], numpy.floating))
+
+    def test_prange_split(self):
+        for args in ((0, 10, 4), (2, 11, 3), (0, 4, 4), (5, 5, 2)):
+            p0, p1 = lib.prange_split(*args)
+            self.assertEqual(list(zip(p0.tolist(), p1.tolist())),
+                             list(lib.prange(*args)))
+
+    def test_as_memmap(self):
+        a = numpy.random.random((3,4))
+        f = lib.H5TmpFile()
+        f['a'] = a
+        m = lib.as_memmap(f['a'])
+        self.assertTrue(numpy.array_equal(m, a))
+        m = lib.as_memmap(f['a'], mode='r+')
+        m[0] = 1.
+        m.flush()
+        self.assertTrue(numpy.all(f['a'][0] == 1.))
+        f.create_dataset('b', (4,4), chunks=(2,2))
+        self.assertRaises(ValueError, lib.as_memmap, f['b'])
+        f.close()
+        f = lib.H5CoreTmpFile()
+        f['a'] = a
+        self.assertRaises(ValueError, lib.as_memmap, f['a'])
+        f.close()
+
+    def test_tril_equal_pace_arr(self):
+        for kwargs, ref in (
+            (dict(npace=3), [(0, 6), (6, 8), (8, 10)]),
+            (dict(base=12), [(0, 4), (4, 6), (6, 7), (7, 8), (8, 9), (9, 10)]),
+            # falls back to _balanced_partition
+            (dict(npace=10), [(0, 3), (3, 4), (4, 5), (5, 6), (6, 7),
+                              (7, 8), (8, 8), (8, 9), (9, 9), (9, 10)])):
+            p0, p1 = lib.tril_equal_pace_arr(10, **kwargs)
+            self.assertEqual(list(zip(p0.tolist(), p1.tolist())), ref)
+            self.assertEqual(list(lib.tril_equal_pace(10, **kwargs)), ref)
+
+    def test_h5coretmpfile(self):
+        # The anonymous file is not backed by the file system
+        f = lib.H5CoreTmpFile(None, 'w')
+        self.assertEqual(f.driver, 'core')
+        self.assertFalse(f.id.get_access_plist().get_fapl_core()[1])
+        f.close()
+        # The named file is saved when it is closed
+        with tempfile.NamedTemporaryFile(dir=lib.param.TMPDIR) as tmpf:
+            f = lib.H5CoreTmpFile(tmpf.name, 'w')
+            f['a'] = numpy.arange(3)
+            f.close()
+            with h5py.File(tmpf.name, 'r') as f:
+                self.assertTrue(numpy.array_equal(f['a'], numpy.arange(3)))
+            f = lib.H5CoreTmpFile(tmpf.name, 'w', backing_store=False)
+            f['b'] = numpy.arange(3)
+            f.close()
+            with h5py.File(tmpf.name, 'r') as f:
+                self.assertEqual(list(f.keys()), ['a'])
+
+if __name__ == "__main__":
+    print("Full Tests for lib.misc")
+    unittest.main()
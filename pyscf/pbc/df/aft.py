@@ -9,6 +9,7 @@ import time
 import ctypes
 import numpy
 import copy
+import collections
 from pyscf import lib
 from pyscf import gto
 from pyscf.lib import logger
@@ -80,10 +81,10 @@ def get_nuc(mydf, kpts=None):
 # rho_ij(G) nuc(-G) / G^2
 # = [Re(rho_ij(G)) + Im(rho_ij(G))*1j] [Re(nuc(G)) - Im(nuc(G))*1j] / G^2
             if gamma_point(kpts_lst[k]):
-                vj[k] += numpy.einsum('k,kx->x', vG[p0:p1].real, aoao.real)
-                vj[k] += numpy.einsum('k,kx->x', vG[p0:p1].imag, aoao.imag)
+                vj[k] += numpy.dot(vG[p0:p1].real, aoao.real)
+                vj[k] += numpy.dot(vG[p0:p1].imag, aoao.imag)
             else:
-                vj[k] += numpy.einsum('k,kx->x', vG[p0:p1].conj(), aoao)
+                vj[k] += numpy.dot(vG[p0:p1].conj(), aoao)
     t1 = log.timer_debug1('contracting Vnuc', *t1)
 
     vj_kpts = []
@@ -167,6 +168,10 @@ class AFTDF(lib.StreamObject):
         self.gs = cell.gs
 
         self.blockdim = 240 # to mimic molecular DF object
+# Evaluate the exchange matrix of get_k_kpts with single precision AO pair
+# products (results are still accumulated in double precision).  It halves
+# the memory traffic of the K build.  Only meant for the early SCF cycles.
+        self.jk_single_prec = False
 
 # Not input options
         self.exxdiv = None  # to mimic KRHF/KUHF object in function get_coulG
@@ -195,9 +200,8 @@ class AFTDF(lib.StreamObject):
             q = kptj - kpti
 
         ao_loc = cell.ao_loc_nr()
-        Gv, Gvbase, kws = cell.get_Gv_weights(gs)
+        Gv, Gvbase, kws, gxyz = self._get_Gv_gxyz(gs)
         b = cell.reciprocal_vectors()
-        gxyz = lib.cartesian_prod([numpy.arange(len(x)) for x in Gvbase])
         ngs = gxyz.shape[0]
 
         if shls_slice is None:
@@ -253,8 +257,7 @@ class AFTDF(lib.StreamObject):
 
         ao_loc = cell.ao_loc_nr()
         b = cell.reciprocal_vectors()
-        Gv, Gvbase, kws = cell.get_Gv_weights(gs)
-        gxyz = lib.cartesian_prod([numpy.arange(len(x)) for x in Gvbase])
+        Gv, Gvbase, kws, gxyz = self._get_Gv_gxyz(gs)
         ngs = gxyz.shape[0]
 
         if shls_slice is None:
@@ -280,11 +283,31 @@ class AFTDF(lib.StreamObject):
     def prange(self, start, stop, step):
         return lib.prange(start, stop, step)
 
+    def _get_Gv_gxyz(self, gs):
+        '''cell.get_Gv_weights(gs) and the indices gxyz of the G vectors.
+        They are cached for the last few grids since the JK builds call
+        ft_loop with the same grid in every SCF iteration.
+        '''
+        cell = self.cell
+        key = (cell.dimension, tuple(numpy.ravel(gs)),
+               tuple(cell.lattice_vectors().ravel()))
+        cache = self.__dict__.setdefault('_Gv_cache', collections.OrderedDict())
+        if key in cache:
+            return cache[key]
+
+        Gv, Gvbase, kws = cell.get_Gv_weights(gs)
+        gxyz = lib.cartesian_prod([numpy.arange(len(x)) for x in Gvbase])
+        # A fine grid takes tens of MB.  Keep two grids at most.
+        while len(cache) >= 2:
+            cache.popitem(last=False)
+        cache[key] = Gv, Gvbase, kws, gxyz
+        return Gv, Gvbase, kws, gxyz
+
     def weighted_coulG(self, kpt=numpy.zeros(3), exx=False, gs=None):
         cell = self.cell
         if gs is None:
             gs = self.gs
-        Gv, Gvbase, kws = cell.get_Gv_weights(gs)
+        Gv, Gvbase, kws = self._get_Gv_gxyz(gs)[:3]
         coulG = tools.get_coulG(cell, kpt, exx, self, gs, Gv)
         coulG *= kws
         return coulG
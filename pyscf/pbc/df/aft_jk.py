@@ -8,11 +8,12 @@ JK with analytic Fourier transformation
 '''
 
 import time
+import collections
 import numpy
 from pyscf import lib
 from pyscf.lib import logger
 from pyscf.pbc import tools
-from pyscf.pbc.df.df_jk import zdotNN, zdotCN, zdotNC, _ewald_exxdiv_for_G0
+from pyscf.pbc.df.df_jk import _ewald_exxdiv_for_G0
 from pyscf.pbc.df.df_jk import _format_dms, _format_kpts_band, _format_jks
 from pyscf.pbc.lib.kpt_misc import is_zero, gamma_point
 
@@ -28,28 +29,30 @@ def get_j_kpts(mydf, dm_kpts, hermi=1, kpts=numpy.zeros((1,3)), kpts_band=None):
     dm_kpts = lib.asarray(dm_kpts, order='C')
     dms = _format_dms(dm_kpts, kpts)
     nset, nkpts, nao = dms.shape[:3]
-    vj_kpts = numpy.zeros((nset,nkpts,nao,nao), dtype=numpy.complex128)
+    # vj_kpts[k] is contiguous so that the GEMMs can accumulate into it
+    vj_kpts = numpy.zeros((nkpts,nset,nao**2), dtype=numpy.complex128)
     kpt_allow = numpy.zeros(3)
     coulG = mydf.weighted_coulG(kpt_allow, False, mydf.gs)
+    coulG *= 1./len(kpts)
     max_memory = (mydf.max_memory - lib.current_memory()[0]) * .8
-    weight = 1./len(kpts)
-    dmsC = dms.conj()
+    dmsC = numpy.asarray(dms.conj().transpose(1,0,2,3), order='C')
+    dmsC = dmsC.reshape(nkpts,nset,nao**2)
     for aoaoks, p0, p1 in mydf.ft_loop(mydf.gs, kpt_allow, kpts, max_memory=max_memory):
-        vG = [0] * nset
         #:rho = numpy.einsum('lkL,lk->L', pqk.conj(), dm)
+        vG = numpy.zeros((nset,p1-p0), dtype=numpy.complex128)
         for k, aoao in enumerate(aoaoks):
-            for i in range(nset):
-                rho = numpy.einsum('ij,Lij->L', dmsC[i,k], aoao).conj()
-                vG[i] += rho * coulG[p0:p1]
-        for i in range(nset):
-            vG[i] *= weight
+            lib.dot(dmsC[k], aoao.reshape(p1-p0,nao**2).T, 1, vG, 1)
+        vG = numpy.conj(vG, out=vG)
+        vG *= coulG[p0:p1]
         for k, aoao in enumerate(aoaoks):
-            for i in range(nset):
-                vj_kpts[i,k] += numpy.einsum('L,Lij->ij', vG[i], aoao)
-    aoao = aoaoks = p0 = p1 = None
+            lib.dot(vG, aoao.reshape(p1-p0,nao**2), 1, vj_kpts[k], 1)
+    aoao = aoaoks = vG = p0 = p1 = None
 
+    vj_kpts = vj_kpts.reshape(nkpts,nset,nao,nao).transpose(1,0,2,3)
     if gamma_point(kpts):
-        vj_kpts = vj_kpts.real.copy()
+        vj_kpts = numpy.asarray(vj_kpts.real, order='C')
+    else:
+        vj_kpts = numpy.asarray(vj_kpts, order='C')
     return _format_jks(vj_kpts, dm_kpts, kpts_band, kpts)
 
 def get_j_for_bands(mydf, dm_kpts, hermi=1, kpts=numpy.zeros((1,3)), kpts_band=None):
@@ -65,34 +68,38 @@ def get_j_for_bands(mydf, dm_kpts, hermi=1, kpts=numpy.zeros((1,3)), kpts_band=N
     dmsI = dms.imag.reshape(nset,nkpts,nao**2)
     kpt_allow = numpy.zeros(3)
     coulG = mydf.weighted_coulG(kpt_allow, False, mydf.gs)
+    coulG *= 1./len(kpts)
     ngs = len(coulG)
-    vG = numpy.zeros((nset,ngs), dtype=numpy.complex128)
+    vG = numpy.empty((nset,ngs), dtype=numpy.complex128)
     max_memory = (mydf.max_memory - lib.current_memory()[0]) * .8
 
-    dmsC = dms.conj()
+    dmsC = numpy.asarray(dms.conj().transpose(1,0,2,3), order='C')
+    dmsC = dmsC.reshape(nkpts,nset,nao**2)
     for aoaoks, p0, p1 in mydf.ft_loop(mydf.gs, kpt_allow, kpts, max_memory=max_memory):
         #:rho = numpy.einsum('lkL,lk->L', pqk.conj(), dm)
+        rho = numpy.zeros((nset,p1-p0), dtype=numpy.complex128)
         for k, aoao in enumerate(aoaoks):
-            for i in range(nset):
-                rho = numpy.einsum('ij,Lij->L', dmsC[i,k], aoao).conj()
-                vG[i,p0:p1] += rho * coulG[p0:p1]
-    aoao = aoaoks = p0 = p1 = None
-    weight = 1./len(kpts)
-    vG *= weight
+            lib.dot(dmsC[k], aoao.reshape(p1-p0,nao**2).T, 1, rho, 1)
+        rho = numpy.conj(rho, out=rho)
+        numpy.multiply(rho, coulG[p0:p1], out=vG[:,p0:p1])
+    aoao = aoaoks = rho = p0 = p1 = None
     t1 = log.timer_debug1('get_j pass 1 to compute J(G)', *t1)
 
     kpts_band, single_kpt_band = _format_kpts_band(kpts_band, kpts)
     nband = len(kpts_band)
-    vj_kpts = numpy.zeros((nset,nband,nao,nao), dtype=numpy.complex128)
+    vj_kpts = numpy.zeros((nband,nset,nao**2), dtype=numpy.complex128)
     for aoaoks, p0, p1 in mydf.ft_loop(mydf.gs, kpt_allow, kpts_band,
                                         max_memory=max_memory):
+        vGblk = numpy.asarray(vG[:,p0:p1], order='C')
         for k, aoao in enumerate(aoaoks):
-            for i in range(nset):
-                vj_kpts[i,k] += numpy.einsum('L,Lij->ij', vG[i,p0:p1], aoao)
-    aoao = aoaoks = p0 = p1 = None
+            lib.dot(vGblk, aoao.reshape(p1-p0,nao**2), 1, vj_kpts[k], 1)
+    aoao = aoaoks = vGblk = p0 = p1 = None
 
+    vj_kpts = vj_kpts.reshape(nband,nset,nao,nao).transpose(1,0,2,3)
     if gamma_point(kpts_band):
-        vj_kpts = vj_kpts.real.copy()
+        vj_kpts = numpy.asarray(vj_kpts.real, order='C')
+    else:
+        vj_kpts = numpy.asarray(vj_kpts, order='C')
     t1 = log.timer_debug1('get_j pass 2', *t1)
     return _format_jks(vj_kpts, dm_kpts, kpts_band, kpts, single_kpt_band)
 
@@ -111,19 +118,72 @@ def get_k_kpts(mydf, dm_kpts, hermi=1, kpts=numpy.zeros((1,3)), kpts_band=None,
     nband = len(kpts_band)
     kk_table = kpts_band.reshape(-1,1,3) - kpts.reshape(1,-1,3)
     kk_todo = numpy.ones(kk_table.shape[:2], dtype=bool)
-    vkR = numpy.zeros((nset,nband,nao,nao))
-    vkI = numpy.zeros((nset,nband,nao,nao))
-    dmsR = numpy.asarray(dms.real, order='C')
-    dmsI = numpy.asarray(dms.imag, order='C')
+    # Group the flattened (ki,kj) indices by kptj-kpti, in the order the
+    # groups first appear.  Rounding only decides the grouping.  A pair which
+    # falls in a neighbouring group is still computed, in a make_kpt call of
+    # its own.
+    kk_groups = collections.OrderedDict()
+    for ij, key in enumerate(numpy.round(-kk_table.reshape(-1,3), 9)):
+        kk_groups.setdefault(tuple(key), []).append(ij)
+    # At the Gamma point with real density matrices only the real part of
+    # the AO pair products contributes to vk
+    k_real = (gamma_point(kpts) and gamma_point(kpts_band) and
+              not numpy.iscomplexobj(dm_kpts))
+    # The K GEMMs run in single precision when mydf.jk_single_prec is set.
+    # vk is always accumulated in double precision.
+    if k_real:
+        vk_kpts = numpy.zeros((nset,nband,nao,nao))
+        kdtype = numpy.float32 if mydf.jk_single_prec else numpy.double
+        dmsX = numpy.asarray(dms.real, dtype=kdtype)
+    else:
+        vk_kpts = numpy.zeros((nset,nband,nao,nao), dtype=numpy.complex128)
+        kdtype = numpy.complex64 if mydf.jk_single_prec else numpy.complex128
+        dmsX = numpy.asarray(dms, dtype=kdtype)
+    # dm sets stacked along columns (dmsT[k] = [dm_0|dm_1|...]) or rows
+    # (dmsS[k]) so that each k-point needs one GEMM for all sets
+    dmsT = numpy.asarray(dmsX.transpose(1,2,0,3), order='C')
+    dmsT = dmsT.reshape(nkpts,nao,nset*nao)
+    dmsS = numpy.asarray(dmsX.transpose(1,0,2,3), order='C')
+    dmsS = dmsS.reshape(nkpts,nset*nao,nao)
+    dmsX = None
+
+    if mydf.jk_single_prec:
+        # lib.dot has BLAS kernels for double precision only.  numpy.dot
+        # writes the single precision products to the scratch directly, then
+        # each contribution to vk is upcast once when it is added.
+        vkbuf = numpy.empty((nao,nao), dtype=kdtype)
+        def dot(a, b, c, beta=0):
+            if beta == 0:
+                return numpy.dot(a, b, out=c)
+            c += numpy.dot(a, b, out=vkbuf)
+            return c
+    else:
+        def dot(a, b, c, beta=0):
+            return lib.dot(a, b, 1, c, beta)
 
     mem_now = lib.current_memory()[0]
     max_memory = max(2000, (mydf.max_memory - mem_now)) * .8
     log.debug1('max_memory = %d MB (%d in use)', max_memory, mem_now)
+
+    # Scratch for pLq, pLq.conj() (or the real and imaginary parts of pLq if
+    # k_real), iLk and iLk of all dm sets, shared by all
+    # make_kpt calls.  It grows to the largest G block generated by ft_loop.
+    scratch = []
+    def get_scratch(size):
+        if not scratch or scratch[0].size < size:
+            del(scratch[:])  # release the old buffers before allocating
+            scratch[:] = [numpy.empty(size, dtype=kdtype),
+                          numpy.empty(size, dtype=kdtype),
+                          numpy.empty(size, dtype=kdtype),
+                          numpy.empty(size*nset, dtype=kdtype)]
+        return scratch
+
     # K_pq = ( p{k1} i{k2} | i{k2} q{k1} )
     def make_kpt(kpt):  # kpt = kptj - kpti
         # search for all possible ki and kj that has ki-kj+kpt=0
-        kk_match = numpy.einsum('ijx->ij', abs(kk_table + kpt)) < 1e-9
-        kpti_idx, kptj_idx = numpy.where(kk_todo & kk_match)
+        kk_match = numpy.asarray(kk_groups[tuple(numpy.round(kpt, 9))])
+        kk_match = kk_match[kk_todo.ravel()[kk_match]]
+        kpti_idx, kptj_idx = kk_match // nkpts, kk_match % nkpts
         nkptj = len(kptj_idx)
         log.debug1('kpt = %s', kpt)
         log.debug2('kpti_idx = %s', kpti_idx)
@@ -132,65 +192,82 @@ def get_k_kpts(mydf, dm_kpts, hermi=1, kpts=numpy.zeros((1,3)), kpts_band=None,
         if swap_2e and not is_zero(kpt):
             kk_todo[kptj_idx,kpti_idx] = False
 
-        max_memory1 = max_memory * (nkptj+1)/(nkptj+5)
-        blksize = max(int(max_memory1*4e6/(nkptj+5)/16/nao**2), 16)
-        bufR = numpy.empty((blksize*nao**2))
-        bufI = numpy.empty((blksize*nao**2))
+        # ft_loop holds nkptj AO-pair blocks, the scratch nset+3 more.  A
+        # scratch left by an earlier make_kpt call which is larger than the
+        # share of this call is released, so that the two together stay
+        # within max_memory.
+        max_memory1 = max_memory * nkptj/(nkptj+nset+3)
+        if scratch:
+            scratch_mem = sum(x.nbytes for x in scratch) / 1e6
+            if scratch_mem > max_memory - max_memory1:
+                del(scratch[:])
         # Use DF object to mimic KRHF/KUHF object in function get_coulG
         mydf.exxdiv = exxdiv
         vkcoulG = mydf.weighted_coulG(kpt, True, mydf.gs)
+        sqrt_vkcoulG = numpy.sqrt(vkcoulG)
         kptjs = kpts[kptj_idx]
         # <r|-G+k_rs|s> = conj(<s|G-k_rs|r>) = conj(<s|G+k_sr|r>)
-        buf1R = numpy.empty((blksize*nao**2))
-        buf1I = numpy.empty((blksize*nao**2))
         for aoaoks, p0, p1 in mydf.ft_loop(mydf.gs, kpt, kptjs, max_memory=max_memory1):
-            coulG = numpy.sqrt(vkcoulG[p0:p1])
             nG = p1 - p0
+            # Scale the AO pairs of all kptjs in one pass, and set up the
+            # buffer views once for all kptjs of this G block
+            aoaoks = aoaoks.reshape(nkptj,nG,nao,nao)
+            aoaoks *= sqrt_vkcoulG[p0:p1].reshape(1,nG,1,1)
+            buf, bufC, buf1, bufs = get_scratch(nG*nao**2)
+            pLq = numpy.ndarray((nao,nG,nao), dtype=kdtype, buffer=buf)
+            pLqC = numpy.ndarray((nao,nG,nao), dtype=kdtype, buffer=bufC)
+            iLks1 = numpy.ndarray((nao*nG,nset*nao), dtype=kdtype, buffer=bufs)
+            iLks2 = numpy.ndarray((nset*nao,nG*nao), dtype=kdtype, buffer=bufs)
+            if nset == 1:
+                iLk = iLks1
+            else:
+                iLk = numpy.ndarray((nao*nG,nao), dtype=kdtype, buffer=buf1)
             for k, aoao in enumerate(aoaoks):
                 ki = kpti_idx[k]
                 kj = kptj_idx[k]
 
+                if k_real:
+                    #:vk = (pLq dm pLq^H).real = pLqR dm pLqR^T + pLqI dm pLqI^T
+                    pLqR, pLqI = pLq, pLqC
+                    pLqR[:] = aoao.real.transpose(1,0,2)
+                    pLqI[:] = aoao.imag.transpose(1,0,2)
+                    for pLqX in (pLqR, pLqI):
+                        dot(pLqX.reshape(-1,nao), dmsT[kj], iLks1)
+                        for i in range(nset):
+                            if nset > 1:
+                                iLk[:] = iLks1.reshape(-1,nset,nao)[:,i]
+                            dot(iLk.reshape(nao,-1), pLqX.reshape(nao,-1).T,
+                                vk_kpts[i,ki], 1)
+                    continue
+
 # case 1: k_pq = (pi|iq)
 #:v4 = numpy.einsum('ijL,lkL->ijkl', pqk, pqk.conj())
 #:vk += numpy.einsum('ijkl,jk->il', v4, dm)
-                pLqR = numpy.ndarray((nao,nG,nao), buffer=bufR)
-                pLqI = numpy.ndarray((nao,nG,nao), buffer=bufI)
-                pLqR[:] = aoao.real.reshape(nG,nao,nao).transpose(1,0,2)
-                pLqI[:] = aoao.imag.reshape(nG,nao,nao).transpose(1,0,2)
-                pLqR *= coulG.reshape(1,nG,1)
-                pLqI *= coulG.reshape(1,nG,1)
-                iLkR = numpy.ndarray((nao*nG,nao), buffer=buf1R)
-                iLkI = numpy.ndarray((nao*nG,nao), buffer=buf1I)
+                pLq[:] = aoao.transpose(1,0,2)
+                numpy.conj(pLq, out=pLqC)
+                dot(pLq.reshape(-1,nao), dmsT[kj], iLks1)
                 for i in range(nset):
-                    iLkR, iLkI = zdotNN(pLqR.reshape(-1,nao), pLqI.reshape(-1,nao),
-                                        dmsR[i,kj], dmsI[i,kj], 1, iLkR, iLkI)
-                    zdotNC(iLkR.reshape(nao,-1), iLkI.reshape(nao,-1),
-                           pLqR.reshape(nao,-1).T, pLqI.reshape(nao,-1).T,
-                           1, vkR[i,ki], vkI[i,ki], 1)
+                    if nset > 1:
+                        iLk[:] = iLks1.reshape(-1,nset,nao)[:,i]
+                    dot(iLk.reshape(nao,-1), pLqC.reshape(nao,-1).T,
+                        vk_kpts[i,ki], 1)
 
 # case 2: k_pq = (iq|pi)
 #:v4 = numpy.einsum('iLj,lLk->ijkl', pqk, pqk.conj())
 #:vk += numpy.einsum('ijkl,li->kj', v4, dm)
                 if swap_2e and not is_zero(kpt):
-                    iLkR = iLkR.reshape(nao,-1)
-                    iLkI = iLkI.reshape(nao,-1)
+                    dot(dmsS[ki], pLq.reshape(nao,-1), iLks2)
                     for i in range(nset):
-                        iLkR, iLkI = zdotNN(dmsR[i,ki], dmsI[i,ki], pLqR.reshape(nao,-1),
-                                            pLqI.reshape(nao,-1), 1, iLkR, iLkI)
-                        zdotCN(pLqR.reshape(-1,nao).T, pLqI.reshape(-1,nao).T,
-                               iLkR.reshape(-1,nao), iLkI.reshape(-1,nao),
-                               1, vkR[i,kj], vkI[i,kj], 1)
-
-    for ki, kpti in enumerate(kpts_band):
-        for kj, kptj in enumerate(kpts):
-            if kk_todo[ki,kj]:
-                make_kpt(kptj-kpti)
-
-    if (gamma_point(kpts) and gamma_point(kpts_band) and
-        not numpy.iscomplexobj(dm_kpts)):
-        vk_kpts = vkR
-    else:
-        vk_kpts = vkR + vkI * 1j
+                        dot(pLqC.reshape(-1,nao).T,
+                            iLks2[i*nao:(i+1)*nao].reshape(-1,nao),
+                            vk_kpts[i,kj], 1)
+
+    # One make_kpt call per unique kptj-kpti.  Groups already covered by the
+    # swap_2e symmetry of an earlier group are skipped.
+    for ijs in kk_groups.values():
+        if kk_todo.ravel()[ijs[0]]:
+            make_kpt(-kk_table.reshape(-1,3)[ijs[0]])
+    scratch = None
     vk_kpts *= 1./nkpts
 
     # G=0 was not included in the non-uniform grids
@@ -231,89 +308,89 @@ def get_jk(mydf, dm, hermi=1, kpt=numpy.zeros(3),
     j_real = gamma_point(kpt)
     k_real = gamma_point(kpt) and not numpy.iscomplexobj(dms)
 
-    kptii = numpy.asarray((kpt,kpt))
     kpt_allow = numpy.zeros(3)
 
     if with_j:
         vjcoulG = mydf.weighted_coulG(kpt_allow, False, mydf.gs)
-        vjR = numpy.zeros((nset,nao,nao))
-        vjI = numpy.zeros((nset,nao,nao))
+        vj = numpy.zeros((nset,nao**2), dtype=numpy.complex128)
+        dmsC = dms.conj().reshape(nset,nao**2)
     if with_k:
         mydf.exxdiv = exxdiv
         vkcoulG = mydf.weighted_coulG(kpt_allow, True, mydf.gs)
-        vkR = numpy.zeros((nset,nao,nao))
-        vkI = numpy.zeros((nset,nao,nao))
-    dmsR = numpy.asarray(dms.real.reshape(nset,nao,nao), order='C')
-    dmsI = numpy.asarray(dms.imag.reshape(nset,nao,nao), order='C')
+        sqrt_vkcoulG = numpy.sqrt(vkcoulG)
+        if k_real:
+            vk = numpy.zeros((nset,nao,nao))
+            dmsR = numpy.asarray(dms.real, order='C')
+        else:
+            vk = numpy.zeros((nset,nao,nao), dtype=numpy.complex128)
+            dmsZ = numpy.asarray(dms, dtype=numpy.complex128, order='C')
     mem_now = lib.current_memory()[0]
     max_memory = max(2000, (mydf.max_memory - mem_now)) * .8
     log.debug1('max_memory = %d MB (%d in use)', max_memory, mem_now)
     t2 = t1
 
-    # rho_rs(-G+k_rs) is computed as conj(rho_{rs^*}(G-k_rs))
-    #                 == conj(transpose(rho_sr(G+k_sr), (0,2,1)))
+    # AO pairs from ft_loop are in (G,p,q) order. They are transposed once
+    # to pLq (p,G,q) for K and the ft_loop buffer is then reused for iLk.
     blksize = max(int(max_memory*.25e6/16/nao**2), 16)
-    bufR = numpy.empty(blksize*nao**2)
-    bufI = numpy.empty(blksize*nao**2)
-    for pqkR, pqkI, p0, p1 in mydf.pw_loop(mydf.gs, kptii, max_memory=max_memory):
+    if with_k and k_real:
+        bufR = numpy.empty(blksize*nao**2)
+        bufI = numpy.empty(blksize*nao**2)
+    elif with_k:
+        buf = numpy.empty(blksize*nao**2, dtype=numpy.complex128)
+        bufC = numpy.empty(blksize*nao**2, dtype=numpy.complex128)
+    for aoaoks, p0, p1 in mydf.ft_loop(mydf.gs, kpt_allow, numpy.reshape(kpt,(1,3)),
+                                        max_memory=max_memory*.25):
         t2 = log.timer_debug1('%d:%d ft_aopair'%(p0,p1), *t2)
-        pqkR = pqkR.reshape(nao,nao,-1)
-        pqkI = pqkI.reshape(nao,nao,-1)
+        nG = p1 - p0
+        aoao = aoaoks[0].reshape(nG,nao**2)
         if with_j:
             #:v4 = numpy.einsum('ijL,lkL->ijkl', pqk, pqk.conj())
             #:vj += numpy.einsum('ijkl,lk->ij', v4, dm)
-            for i in range(nset):
-                rhoR = numpy.einsum('pq,pqk->k', dmsR[i], pqkR)
-                rhoR+= numpy.einsum('pq,pqk->k', dmsI[i], pqkI)
-                rhoI = numpy.einsum('pq,pqk->k', dmsI[i], pqkR)
-                rhoI-= numpy.einsum('pq,pqk->k', dmsR[i], pqkI)
-                rhoR *= vjcoulG[p0:p1]
-                rhoI *= vjcoulG[p0:p1]
-                vjR[i] += numpy.einsum('pqk,k->pq', pqkR, rhoR)
-                vjR[i] -= numpy.einsum('pqk,k->pq', pqkI, rhoI)
-                if not j_real:
-                    vjI[i] += numpy.einsum('pqk,k->pq', pqkR, rhoI)
-                    vjI[i] += numpy.einsum('pqk,k->pq', pqkI, rhoR)
+            rho = lib.dot(dmsC, aoao.T)
+            rho = numpy.conj(rho, out=rho)
+            rho *= vjcoulG[p0:p1]
+            lib.dot(rho, aoao, 1, vj, 1)
         #t2 = log.timer_debug1('        with_j', *t2)
 
         if with_k:
-            coulG = numpy.sqrt(vkcoulG[p0:p1])
-            pqkR *= coulG
-            pqkI *= coulG
+            aoao *= sqrt_vkcoulG[p0:p1].reshape(nG,1)
             #:v4 = numpy.einsum('ijL,lkL->ijkl', pqk, pqk.conj())
             #:vk += numpy.einsum('ijkl,jk->il', v4, dm)
-            pLqR = lib.transpose(pqkR, axes=(0,2,1), out=bufR).reshape(-1,nao)
-            pLqI = lib.transpose(pqkI, axes=(0,2,1), out=bufI).reshape(-1,nao)
-            iLkR = numpy.ndarray((nao*(p1-p0),nao), buffer=pqkR)
-            iLkI = numpy.ndarray((nao*(p1-p0),nao), buffer=pqkI)
-            for i in range(nset):
-                if k_real:
+            if k_real:
+                pLqR = numpy.ndarray((nao,nG,nao), buffer=bufR)
+                pLqI = numpy.ndarray((nao,nG,nao), buffer=bufI)
+                pLqR[:] = aoao.real.reshape(nG,nao,nao).transpose(1,0,2)
+                pLqI[:] = aoao.imag.reshape(nG,nao,nao).transpose(1,0,2)
+                pLqR = pLqR.reshape(-1,nao)
+                pLqI = pLqI.reshape(-1,nao)
+                iLkR = numpy.ndarray((nao*nG,nao), buffer=aoao)
+                iLkI = numpy.ndarray((nao*nG,nao), buffer=aoao, offset=iLkR.nbytes)
+                for i in range(nset):
                     lib.dot(pLqR, dmsR[i], 1, iLkR)
                     lib.dot(pLqI, dmsR[i], 1, iLkI)
-                    lib.dot(iLkR.reshape(nao,-1), pLqR.reshape(nao,-1).T, 1, vkR[i], 1)
-                    lib.dot(iLkI.reshape(nao,-1), pLqI.reshape(nao,-1).T, 1, vkR[i], 1)
-                else:
-                    zdotNN(pLqR, pLqI, dmsR[i], dmsI[i], 1, iLkR, iLkI)
-                    zdotNC(iLkR.reshape(nao,-1), iLkI.reshape(nao,-1),
-                           pLqR.reshape(nao,-1).T, pLqI.reshape(nao,-1).T,
-                           1, vkR[i], vkI[i])
+                    lib.dot(iLkR.reshape(nao,-1), pLqR.reshape(nao,-1).T, 1, vk[i], 1)
+                    lib.dot(iLkI.reshape(nao,-1), pLqI.reshape(nao,-1).T, 1, vk[i], 1)
+            else:
+                pLq = numpy.ndarray((nao,nG,nao), dtype=numpy.complex128, buffer=buf)
+                pLq[:] = aoao.reshape(nG,nao,nao).transpose(1,0,2)
+                pLqC = numpy.ndarray(pLq.shape, dtype=numpy.complex128, buffer=bufC)
+                numpy.conj(pLq, out=pLqC)
+                iLk = numpy.ndarray((nao*nG,nao), dtype=numpy.complex128, buffer=aoao)
+                for i in range(nset):
+                    lib.dot(pLq.reshape(-1,nao), dmsZ[i], 1, iLk)
+                    lib.dot(iLk.reshape(nao,-1), pLqC.reshape(nao,-1).T, 1, vk[i], 1)
             #t2 = log.timer_debug1('        with_k', *t2)
-        pqkR = pqkI = coulG = pLqR = pLqI = iLkR = iLkI = None
+        aoao = aoaoks = rho = None
+        pLqR = pLqI = iLkR = iLkI = pLq = pLqC = iLk = None
         #t2 = log.timer_debug1('%d:%d'%(p0,p1), *t2)
-    bufR = bufI = None
+    bufR = bufI = buf = bufC = None
     t1 = log.timer_debug1('aft_jk.get_jk', *t1)
 
     if with_j:
         if j_real:
-            vj = vjR
-        else:
-            vj = vjR + vjI * 1j
+            vj = vj.real.copy()
         vj = vj.reshape(dm.shape)
     if with_k:
-        if k_real:
-            vk = vkR
-        else:
-            vk = vkR + vkI * 1j
         if cell.dimension != 3 and exxdiv:
             assert(exxdiv.lower() == 'ewald')
             _ewald_exxdiv_for_G0(cell, kpt, dms, vk)
@@ -337,6 +337,7 @@ class DF(aft.AFTDF):
         self.gs = cell.gs
         self.auxbasis = None
         self.eta = estimate_eta(cell, cell.precision)
+        self.jk_single_prec = False  # see AFTDF
 
 # Not input options
         self.exxdiv = None  # to mimic KRHF/KUHF object in function get_coulG
@@ -141,7 +141,7 @@ def wrap_int3c(cell, auxcell, intor='int3c2e_sph', aosym='s1', comp=1,
             Ls.ctypes.data_as(ctypes.c_void_p),
             expkL.ctypes.data_as(ctypes.c_void_p),
             kptij_idx.ctypes.data_as(ctypes.c_void_p),
-            (ctypes.c_int*6)(*shls_slice),
+            lib.c_int6(*shls_slice),
             ao_loc.ctypes.data_as(ctypes.c_void_p), cintopt,
             atm.ctypes.data_as(ctypes.c_void_p), ctypes.c_int(cell.natm),
             bas.ctypes.data_as(ctypes.c_void_p),
@@ -113,6 +113,32 @@ class KnowValues(unittest.TestCase):
         self.assertAlmostEqual(finger(vk[6]), (7.3743790120272408-0.096290683129384574j)/8, 9)
         self.assertAlmostEqual(finger(vk[7]), (6.8144379626901443+0.08071261392857812j) /8, 9)
 
+    def test_aft_k_single_prec(self):
+        kpts = cell.get_abs_kpts([[-.25,-.25,-.25],
+                                  [-.25, .25, .25],
+                                  [ .25,-.25, .25],
+                                  [ .25, .25,-.25]])
+        numpy.random.seed(1)
+        nao = cell.nao_nr()
+        dm = numpy.random.random((2,4,nao,nao))
+        dm = dm + dm.transpose(0,1,3,2)
+        mydf = aft.AFTDF(cell)
+        mydf.gs = [5]*3
+        vk0 = aft_jk.get_k_kpts(mydf, dm, 1, kpts)
+        mydf.jk_single_prec = True
+        vk1 = aft_jk.get_k_kpts(mydf, dm, 1, kpts)
+        self.assertEqual(vk1.dtype, numpy.complex128)
+        self.assertAlmostEqual(abs(vk1-vk0).max(), 0, 5)
+
+        # Gamma point with real density matrices
+        dm = dm[:,0].real.copy()
+        mydf.jk_single_prec = False
+        vk0 = aft_jk.get_k_kpts(mydf, dm, 1, numpy.zeros((1,3)))
+        mydf.jk_single_prec = True
+        vk1 = aft_jk.get_k_kpts(mydf, dm, 1, numpy.zeros((1,3)))
+        self.assertEqual(vk1.dtype, numpy.double)
+        self.assertAlmostEqual(abs(vk1-vk0).max(), 0, 5)
+
 
 
 if __name__ == '__main__':
@@ -4,15 +4,19 @@
 #         Qiming Sun <osirpt.sun@gmail.com>
 #
 
+import sys
 import tempfile
 import ctypes
+import collections
+import threading
 import numpy
+import scipy.linalg
 import h5py
 from pyscf import lib
 from pyscf.scf.hf import _attach_mo
 from pyscf.dft import numint
 from pyscf.dft.numint import eval_mat, _dot_ao_ao, _dot_ao_dm
-from pyscf.dft.numint import OCCDROP
+from pyscf.dft.numint import OCCDROP, SWITCH_SIZE
 from pyscf.pbc.dft.gen_grid import libpbc, make_mask, BLKSIZE
 from pyscf.pbc import tools
 from pyscf.pbc.lib.kpt_misc import is_zero, gamma_point, member
@@ -82,7 +86,7 @@ def eval_ao_kpts(cell, coords, kpts=None, deriv=0, relativity=0,
         if 'kpt' in kwargs:
             sys.stderr.write('WARN: _KNumInt.eval_ao function finds keyword '
                              'argument "kpt" and converts it to "kpts"\n')
-            kpts = kpt
+            kpts = kwargs['kpt']
         else:
             kpts = numpy.zeros((1,3))
     kpts = numpy.reshape(kpts, (-1,3))
@@ -99,14 +103,13 @@ def eval_ao_kpts(cell, coords, kpts=None, deriv=0, relativity=0,
     ao_loc = cell.ao_loc_nr()
     nao = ao_loc[-1]
     comp = (deriv+1)*(deriv+2)*(deriv+3)//6
-    ao_kpts = [numpy.zeros((ngrids,nao,comp), dtype=numpy.complex128, order='F')
-               for k in range(nkpts)]
+    # One buffer for all k-points.  ao_kpts[k] has the memory layout of a
+    # Fortran-ordered (ngrids,nao,comp) array, as required by the C driver.
+    ao_kpts = numpy.zeros((nkpts,comp,nao,ngrids), dtype=numpy.complex128)
     out_ptrs = (ctypes.c_void_p*nkpts)(
             *[x.ctypes.data_as(ctypes.c_void_p) for x in ao_kpts])
     coords = numpy.asarray(coords, order='F')
-    Ls = cell.get_lattice_Ls()
-    Ls = Ls[numpy.argsort(lib.norm(Ls, axis=1))]
-    expLk = numpy.exp(1j * numpy.asarray(numpy.dot(Ls, kpts.T), order='C'))
+    Ls, expLk = _get_Ls_expLk(cell, kpts)
 
     drv = getattr(libpbc, 'PBCval_sph_deriv%d' % deriv)
     drv(ctypes.c_int(ngrids),
@@ -120,14 +123,36 @@ def eval_ao_kpts(cell, coords, kpts=None, deriv=0, relativity=0,
         cell._env.ctypes.data_as(ctypes.c_void_p))
 
     if gamma_point(kpts):
-        ao_kpts = [ao.real.copy(order='F') for ao in ao_kpts]
-    for k, kpt in enumerate(kpts):
-        ao_kpts[k] = ao_kpts[k].transpose(2,0,1)
-        if comp == 1:
-            ao_kpts[k] = ao_kpts[k][0]
+        ao_kpts = numpy.asarray(ao_kpts.real, order='C')
+    # (comp,ngrids,nao) views on the buffer, each ao_kpts[k][i] F-contiguous
+    ao_kpts = [ao.transpose(0,2,1) for ao in ao_kpts]
+    if comp == 1:
+        ao_kpts = [ao[0] for ao in ao_kpts]
     return ao_kpts
 
 
+# Ls and expLk only depend on the lattice and the k-points.  eval_ao_kpts is
+# called for every grid block, so they are kept for the latest few inputs.
+# The lock is needed because _KNumInt.block_loop calls eval_ao_kpts in a
+# background thread.
+_Ls_expLk_cache = collections.OrderedDict()
+_Ls_expLk_lock = threading.Lock()
+def _get_Ls_expLk(cell, kpts):
+    key = (cell.dimension, cell.rcut, tuple(cell.lattice_vectors().ravel()),
+           tuple(kpts.ravel()))
+    with _Ls_expLk_lock:
+        if key in _Ls_expLk_cache:
+            return _Ls_expLk_cache[key]
+
+        Ls = cell.get_lattice_Ls()
+        Ls = Ls[numpy.argsort(lib.norm(Ls, axis=1))]
+        expLk = numpy.exp(1j * numpy.asarray(numpy.dot(Ls, kpts.T), order='C'))
+        while len(_Ls_expLk_cache) >= 4:
+            _Ls_expLk_cache.popitem(last=False)
+        _Ls_expLk_cache[key] = Ls, expLk
+        return Ls, expLk
+
+
 def eval_rho(cell, ao, dm, non0tab=None, xctype='LDA', hermi=0, verbose=None):
     '''Collocate the *real* density (opt. gradients) on the real-space grid.
 
@@ -160,18 +185,27 @@ def eval_rho(cell, ao, dm, non0tab=None, xctype='LDA', hermi=0, verbose=None):
                               dtype=numpy.uint8)
         non0tab[:] = 0xff
 
+    if numpy.iscomplexobj(dm) and not numpy.iscomplexobj(ao):
+        # With real orbitals (gamma point), the imaginary part of the DM does
+        # not contribute to the real density
+        dm = numpy.asarray(dm.real, order='C')
+
+    if nao < SWITCH_SIZE:
+        # _dot_ao_dm does not screen AOs for small basis.  Contract over the
+        # AOs which are non-zero on this block only.
+        ao_idx = _non0_ao_idx(cell, non0tab, ngrids)
+        if ao_idx is not None and ao_idx.size < nao*.8:
+            ao = ao[...,ao_idx]
+            dm = dm[ao_idx[:,None],ao_idx]
+
     # complex orbitals or density matrix
     if numpy.iscomplexobj(ao) or numpy.iscomplexobj(dm):
         shls_slice = (0, cell.nbas)
         ao_loc = cell.ao_loc_nr()
         if not hermi:
             dm = (dm + dm.conj().T) * .5
-        dm = dm.astype(numpy.complex128)
-
-        def dot_bra(bra, aodm):
-            rho  = numpy.einsum('pi,pi->p', bra.real, aodm.real)
-            rho += numpy.einsum('pi,pi->p', bra.imag, aodm.imag)
-            return rho
+        dm = numpy.asarray(dm, dtype=numpy.complex128)
+        dot_bra = _contract_rho
 
         if xctype == 'LDA':
             c0 = _dot_ao_dm(cell, ao, dm, non0tab, shls_slice, ao_loc)
@@ -182,7 +216,8 @@ def eval_rho(cell, ao, dm, non0tab=None, xctype='LDA', hermi=0, verbose=None):
             c0 = _dot_ao_dm(cell, ao[0], dm, non0tab, shls_slice, ao_loc)
             rho[0] = dot_bra(ao[0], c0)
             for i in range(1, 4):
-                rho[i] = dot_bra(ao[i], c0) * 2
+                rho[i] = dot_bra(ao[i], c0)
+            rho[1:4] *= 2
 
         else:
             # rho[4] = \nabla^2 rho, rho[5] = 1/2 |nabla f|^2
@@ -190,12 +225,16 @@ def eval_rho(cell, ao, dm, non0tab=None, xctype='LDA', hermi=0, verbose=None):
             c0 = _dot_ao_dm(cell, ao[0], dm, non0tab, shls_slice, ao_loc)
             rho[0] = dot_bra(ao[0], c0)
             rho[5] = 0
+            c1 = None
             for i in range(1, 4):
-                rho[i] = dot_bra(ao[i], c0) * 2  # *2 for +c.c.
-                c1 = _dot_ao_dm(cell, ao[i], dm, non0tab, shls_slice, ao_loc)
+                rho[i] = dot_bra(ao[i], c0)
+                c1 = _dot_ao_dm(cell, ao[i], dm, non0tab, shls_slice, ao_loc,
+                                out=c1)
                 rho[5] += dot_bra(ao[i], c1)
+            rho[1:4] *= 2  # *2 for +c.c.
             XX, YY, ZZ = 4, 7, 9
-            ao2 = ao[XX] + ao[YY] + ao[ZZ]
+            ao2 = ao[XX] + ao[YY]
+            ao2 += ao[ZZ]
             rho[4] = dot_bra(ao2, c0)
             rho[4] += rho[5]
             rho[4] *= 2 # *2 for +c.c.
@@ -222,11 +261,7 @@ def eval_rho2(cell, ao, mo_coeff, mo_occ, non0tab=None, xctype='LDA',
 
     # complex orbitals or density matrix
     if numpy.iscomplexobj(ao) or numpy.iscomplexobj(mo_coeff):
-        def dot(bra, ket):
-            rho  = numpy.einsum('pi,pi->p', bra.real, ket.real)
-            rho += numpy.einsum('pi,pi->p', bra.imag, ket.imag)
-            return rho
-
+        dot = _contract_rho
         shls_slice = (0, cell.nbas)
         ao_loc = cell.ao_loc_nr()
         pos = mo_occ > OCCDROP
@@ -298,9 +333,39 @@ def eval_rho2(cell, ao, mo_coeff, mo_occ, non0tab=None, xctype='LDA',
         rho = numint.eval_rho2(cell, ao, mo_coeff, mo_occ, non0tab, xctype, verbose)
     return rho
 
+def _non0_ao_idx(cell, non0tab, ngrids):
+    '''Indices of the AOs which are non-zero on any of the first ngrids grids
+    according to non0tab.  Return None if all AOs are non-zero.
+    '''
+    nblk = (ngrids+BLKSIZE-1) // BLKSIZE
+    shl_mask = non0tab[:nblk].any(axis=0)
+    if shl_mask.all():
+        return None
+    ao_loc = cell.ao_loc_nr()
+    return numpy.repeat(shl_mask, ao_loc[1:]-ao_loc[:-1]).nonzero()[0]
+
+def _contract_rho(bra, ket):
+    '''Real part of numpy.einsum('pi,pi->p', bra.conj(), ket)'''
+    bra = bra.T
+    ket = ket.T
+    if (bra.dtype == ket.dtype == numpy.complex128 and
+        bra.flags.c_contiguous and ket.flags.c_contiguous):
+        # Re(bra.conj()*ket) = bra.real*ket.real + bra.imag*ket.imag.  Viewing
+        # the complex arrays as interleaved (real,imag) pairs, the sum over AOs
+        # is done in one pass on the contiguous data.
+        ngrids = bra.shape[1]
+        rho = numpy.einsum('ip,ip->p', bra.view(numpy.double),
+                           ket.view(numpy.double))
+        rho = rho.reshape(ngrids,2).sum(axis=1)
+    else:
+        rho  = numpy.einsum('ip,ip->p', bra.real, ket.real)
+        rho += numpy.einsum('ip,ip->p', bra.imag, ket.imag)
+    return rho
+
 
 def nr_rks(ni, cell, grids, xc_code, dms, spin=0, relativity=0, hermi=0,
-           kpts=None, kpts_band=None, max_memory=2000, verbose=None):
+           kpts=None, kpts_band=None, max_memory=2000, verbose=None,
+           precomputed_ao=None):
     '''Calculate RKS XC functional and potential matrix for given meshgrids and density matrix
 
     Note: This is a replica of pyscf.dft.numint.nr_rks_vxc with kpts added.
@@ -335,6 +400,9 @@ def nr_rks(ni, cell, grids, xc_code, dms, spin=0, relativity=0, hermi=0,
             Single or multiple k-points sampled for the DM.  Default is gamma point.
         kpts_band : (3,) ndarray or (*,3) ndarray
             A list of arbitrary "band" k-points at which to evaluate the XC matrix.
+        precomputed_ao : ndarray or list of ndarrays
+            AO values (and derivatives) of kpts on all grids.  If given, they
+            are used instead of evaluating the AOs of kpts block by block.
 
     Returns:
         nelec, excsum, vmat.
@@ -345,7 +413,7 @@ def nr_rks(ni, cell, grids, xc_code, dms, spin=0, relativity=0, hermi=0,
     if kpts is None:
         kpts = numpy.zeros((1,3))
     xctype = ni._xc_type(xc_code)
-    make_rho, nset, nao = ni._gen_rho_evaluator(cell, dms, hermi)
+    make_rho, nset, nao = ni._gen_rho_evaluator(cell, dms, hermi, kpts)
 
     nelec = numpy.zeros(nset)
     excsum = numpy.zeros(nset)
@@ -354,7 +422,7 @@ def nr_rks(ni, cell, grids, xc_code, dms, spin=0, relativity=0, hermi=0,
         ao_deriv = 0
         for ao_k1, ao_k2, mask, weight, coords \
                 in ni.block_loop(cell, grids, nao, ao_deriv, kpts, kpts_band,
-                                 max_memory):
+                                 max_memory, precomputed_ao=precomputed_ao):
             for i in range(nset):
                 rho = make_rho(i, ao_k2, mask, xctype)
                 exc, vxc = ni.eval_xc(xc_code, rho, 0, relativity, 1)[:2]
@@ -368,7 +436,7 @@ def nr_rks(ni, cell, grids, xc_code, dms, spin=0, relativity=0, hermi=0,
         ao_deriv = 1
         for ao_k1, ao_k2, mask, weight, coords \
                 in ni.block_loop(cell, grids, nao, ao_deriv, kpts, kpts_band,
-                                 max_memory):
+                                 max_memory, precomputed_ao=precomputed_ao):
             for i in range(nset):
                 rho = make_rho(i, ao_k2, mask, xctype)
                 exc, vxc = ni.eval_xc(xc_code, rho, 0, relativity, 1)[:2]
@@ -382,7 +450,7 @@ def nr_rks(ni, cell, grids, xc_code, dms, spin=0, relativity=0, hermi=0,
         ao_deriv = 2
         for ao_k1, ao_k2, mask, weight, coords \
                 in ni.block_loop(cell, grids, nao, ao_deriv, kpts, kpts_band,
-                                 max_memory):
+                                 max_memory, precomputed_ao=precomputed_ao):
             for i in range(nset):
                 rho = make_rho(i, ao_k2, mask, xctype)
                 exc, vxc = ni.eval_xc(xc_code, rho, 0, relativity, 1)[:2]
@@ -398,7 +466,8 @@ def nr_rks(ni, cell, grids, xc_code, dms, spin=0, relativity=0, hermi=0,
     return nelec, excsum, vmat
 
 def nr_uks(ni, cell, grids, xc_code, dms, spin=1, relativity=0, hermi=0,
-           kpts=None, kpts_band=None, max_memory=2000, verbose=None):
+           kpts=None, kpts_band=None, max_memory=2000, verbose=None,
+           precomputed_ao=None):
     '''Calculate UKS XC functional and potential matrix for given meshgrids and density matrix
 
     Note: This is a replica of pyscf.dft.numint.nr_rks_vxc with kpts added.
@@ -433,6 +502,9 @@ def nr_uks(ni, cell, grids, xc_code, dms, spin=1, relativity=0, hermi=0,
             Single or multiple k-points sampled for the DM.  Default is gamma point.
             kpts_band : (3,) ndarray or (*,3) ndarray
             A list of arbitrary "band" k-points at which to evaluate the XC matrix.
+        precomputed_ao : ndarray or list of ndarrays
+            AO values (and derivatives) of kpts on all grids.  If given, they
+            are used instead of evaluating the AOs of kpts block by block.
 
     Returns:
         nelec, excsum, vmat.
@@ -445,8 +517,8 @@ def nr_uks(ni, cell, grids, xc_code, dms, spin=1, relativity=0, hermi=0,
     xctype = ni._xc_type(xc_code)
     dma, dmb = _format_uks_dm(dms)
     nao = dma.shape[-1]
-    make_rhoa, nset = ni._gen_rho_evaluator(cell, dma, hermi)[:2]
-    make_rhob       = ni._gen_rho_evaluator(cell, dmb, hermi)[0]
+    make_rhoa, nset = ni._gen_rho_evaluator(cell, dma, hermi, kpts)[:2]
+    make_rhob       = ni._gen_rho_evaluator(cell, dmb, hermi, kpts)[0]
 
     nelec = numpy.zeros((2,nset))
     excsum = numpy.zeros(nset)
@@ -456,7 +528,7 @@ def nr_uks(ni, cell, grids, xc_code, dms, spin=1, relativity=0, hermi=0,
         ao_deriv = 0
         for ao_k1, ao_k2, mask, weight, coords \
                 in ni.block_loop(cell, grids, nao, ao_deriv, kpts, kpts_band,
-                                 max_memory):
+                                 max_memory, precomputed_ao=precomputed_ao):
             for i in range(nset):
                 rho_a = make_rhoa(i, ao_k2, mask, xctype)
                 rho_b = make_rhob(i, ao_k2, mask, xctype)
@@ -478,7 +550,8 @@ def nr_uks(ni, cell, grids, xc_code, dms, spin=1, relativity=0, hermi=0,
         ao_deriv = 1
         for ao_k1, ao_k2, mask, weight, coords \
                 in ni.block_loop(cell, grids, nao, ao_deriv, kpts,
-                                 kpts_band, max_memory):
+                                 kpts_band, max_memory,
+                                 precomputed_ao=precomputed_ao):
             for i in range(nset):
                 rho_a = make_rhoa(i, ao_k2, mask, xctype)
                 rho_b = make_rhob(i, ao_k2, mask, xctype)
@@ -503,7 +576,7 @@ def nr_uks(ni, cell, grids, xc_code, dms, spin=1, relativity=0, hermi=0,
         ao_deriv = 2
         for ao_k1, ao_k2, mask, weight, coords \
                 in ni.block_loop(cell, grids, nao, ao_deriv, kpts, kpts_band,
-                                 max_memory):
+                                 max_memory, precomputed_ao=precomputed_ao):
             for i in range(nset):
                 rho_a = make_rhoa(i, ao_k2, mask, xctype)
                 rho_b = make_rhob(i, ao_k2, mask, xctype)
@@ -922,23 +995,121 @@ def cache_xc_kernel(ni, cell, grids, xc_code, mo_coeff, mo_occ, spin=0,
 
 
 def large_rho_indices(ni, cell, dm, grids, cutoff=1e-10, kpt=numpy.zeros(3),
-                      max_memory=2000):
+                      max_memory=2000, precomputed_ao=None):
     '''Indices of density which are larger than given cutoff
     '''
     make_rho, nset, nao = ni._gen_rho_evaluator(cell, dm)
     idx = []
     cutoff = cutoff / grids.weights.size
     for ao_k1, ao_k2, mask, weight, coords \
-            in ni.block_loop(cell, grids, nao, 0, kpt, None, max_memory):
+            in ni.block_loop(cell, grids, nao, 0, kpt, None, max_memory,
+                             precomputed_ao=precomputed_ao):
         rho = make_rho(0, ao_k1, mask, 'LDA')
         idx.append(abs(rho*weight) > cutoff)
     return numpy.hstack(idx)
 
+def _add_rho(rhoR, rho, out=None):
+    '''Accumulate the density of one k-point into rhoR.  The first one is
+    stored in out if given, otherwise it is used as the accumulator.
+    '''
+    if rhoR is not None:
+        rhoR += rho
+    elif out is not None:
+        rhoR = out
+        rhoR[:] = rho
+    else:
+        rhoR = rho
+    return rhoR
+
+def _kpt_pair_weights(kpts, dm_kpts, tol=1e-10):
+    '''Weights of k-points in the density of dm_kpts.
+
+    For a pair (k, -k) with dm(-k) = dm(k).conj(), the AO values at -k are the
+    complex conjugate of those at k and both k-points give the same density.
+    The first k-point of such a pair gets weight 2 and the second weight 0.
+    Other k-points have weight 1.
+    '''
+    nkpts = len(kpts)
+    weights = numpy.ones(nkpts)
+    if len(dm_kpts) != nkpts:
+        return weights
+    for k in range(nkpts):
+        if weights[k] != 1:
+            continue
+        for k2 in range(k+1, nkpts):
+            if (weights[k2] == 1 and abs(kpts[k]+kpts[k2]).sum() < 1e-9 and
+                abs(dm_kpts[k2]-dm_kpts[k].conj()).max() < tol):
+                weights[k] = 2
+                weights[k2] = 0
+                break
+    return weights
+
+def _low_rank_orbitals(dm_kpts, kpt_weights=None):
+    '''Decompose the hermitian dm_kpts into orbitals and occupations,
+    dm_kpts[k] = (c * occ).dot(c.conj().T).  The occupations include the
+    k-point weights.  Return None if any DM is not positive semi-definite or
+    its rank is more than nao/4, for which eval_rho is cheaper than eval_rho2.
+    '''
+    nao = dm_kpts[0].shape[-1]
+    mo_coeff = []
+    mo_occ = []
+    for k, dm in enumerate(dm_kpts):
+        if kpt_weights is not None and kpt_weights[k] == 0:
+            mo_occ.append(numpy.zeros(0))
+            mo_coeff.append(numpy.zeros((nao,0), dtype=dm.dtype))
+            continue
+        e, c = scipy.linalg.eigh(dm)
+        idx = e > OCCDROP
+        if e[0] < -OCCDROP or idx.sum() * 4 > nao:
+            return None
+        if kpt_weights is not None:
+            e *= kpt_weights[k]
+        mo_occ.append(e[idx])
+        mo_coeff.append(c[:,idx])
+    return mo_coeff, mo_occ
+
+def _slice_ao(ao, comp, ip0, ip1):
+    '''AO values of grids ip0:ip1, the first comp components, from the AO
+    values of all grids'''
+    if ao.ndim == 2:
+        assert(comp == 1)
+        return ao[ip0:ip1]
+    elif comp == 1:
+        return ao[0,ip0:ip1]
+    else:
+        return ao[:comp,ip0:ip1]
+
+def _grids_non0tab(ni, cell, grids, ngrids, precomputed_ao=None):
+    '''The AO screening mask of block_loop.  If grids carry no non0tab, the
+    mask is made once and kept on ni until grids.coords or the cell change.
+    '''
+    if grids.non0tab is not None:
+        return grids.non0tab
+    if precomputed_ao is not None:
+        # No AOs are evaluated.  The mask is only passed on to the callers.
+        non0tab = numpy.empty(((ngrids+BLKSIZE-1)//BLKSIZE,cell.nbas),
+                              dtype=numpy.uint8)
+        non0tab[:] = 0xff
+        return non0tab
+    key = (cell._atm, cell._bas, cell._env, cell.lattice_vectors())
+    if ni._non0tab_cache is not None:
+        coords, old_key, non0tab = ni._non0tab_cache
+        if (coords is grids.coords and
+            all(numpy.array_equal(a, b) for a, b in zip(old_key, key))):
+            return non0tab
+    non0tab = ni.make_mask(cell, grids.coords)
+    ni._non0tab_cache = (grids.coords, [numpy.copy(x) for x in key], non0tab)
+    return non0tab
+
 
 class _NumInt(numint._NumInt):
     '''Generalization of pyscf's _NumInt class for a single k-point shift and
     periodic images.
     '''
+    def __init__(self):
+        numint._NumInt.__init__(self)
+        self._non0tab_cache = None
+
     def eval_ao(self, cell, coords, kpt=numpy.zeros(3), deriv=0, relativity=0,
                 shl_slice=None, non0tab=None, out=None, verbose=None):
         return eval_ao(cell, coords, kpt, deriv, relativity, shl_slice,
@@ -970,15 +1141,19 @@ class _NumInt(numint._NumInt):
 
     @lib.with_doc(nr_rks.__doc__)
     def nr_rks(self, cell, grids, xc_code, dms, hermi=0,
-               kpt=numpy.zeros(3), kpt_band=None, max_memory=2000, verbose=None):
+               kpt=numpy.zeros(3), kpt_band=None, max_memory=2000, verbose=None,
+               precomputed_ao=None):
         return nr_rks(self, cell, grids, xc_code, dms,
-                      0, 0, hermi, kpt, kpt_band, max_memory, verbose)
+                      0, 0, hermi, kpt, kpt_band, max_memory, verbose,
+                      precomputed_ao)
 
     @lib.with_doc(nr_uks.__doc__)
     def nr_uks(self, cell, grids, xc_code, dms, hermi=0,
-               kpt=numpy.zeros(3), kpt_band=None, max_memory=2000, verbose=None):
+               kpt=numpy.zeros(3), kpt_band=None, max_memory=2000, verbose=None,
+               precomputed_ao=None):
         return nr_uks(self, cell, grids, xc_code, dms,
-                      1, 0, hermi, kpt, kpt_band, max_memory, verbose)
+                      1, 0, hermi, kpt, kpt_band, max_memory, verbose,
+                      precomputed_ao)
 
     def eval_mat(self, cell, ao, weight, rho, vxc,
                  non0tab=None, xctype='LDA', spin=0, verbose=None):
@@ -989,7 +1164,8 @@ class _NumInt(numint._NumInt):
         return _fxc_mat(cell, ao, wv, non0tab, xctype, ao_loc)
 
     def block_loop(self, cell, grids, nao, deriv=0, kpt=numpy.zeros(3),
-                   kpt_band=None, max_memory=2000, non0tab=None, blksize=None):
+                   kpt_band=None, max_memory=2000, non0tab=None, blksize=None,
+                   precomputed_ao=None):
         '''Define this macro to loop over grids by blocks.
         '''
         ngrids = grids.weights.size
@@ -999,11 +1175,7 @@ class _NumInt(numint._NumInt):
             blksize = min(int(max_memory*1e6/(comp*2*nao*16*BLKSIZE))*BLKSIZE, ngrids)
             blksize = max(blksize, BLKSIZE)
         if non0tab is None:
-            non0tab = grids.non0tab
-        if non0tab is None:
-            non0tab = numpy.empty(((ngrids+BLKSIZE-1)//BLKSIZE,cell.nbas),
-                                  dtype=numpy.uint8)
-            non0tab[:] = 0xff
+            non0tab = _grids_non0tab(self, cell, grids, ngrids, precomputed_ao)
         kpt = numpy.reshape(kpt, 3)
         if kpt_band is None:
             kpt1 = kpt2 = kpt
@@ -1016,7 +1188,10 @@ class _NumInt(numint._NumInt):
             coords = grids.coords[ip0:ip1]
             weight = grids.weights[ip0:ip1]
             non0 = non0tab[ip0//BLKSIZE:]
-            ao_k2 = self.eval_ao(cell, coords, kpt2, deriv=deriv, non0tab=non0)
+            if precomputed_ao is None:
+                ao_k2 = self.eval_ao(cell, coords, kpt2, deriv=deriv, non0tab=non0)
+            else:
+                ao_k2 = _slice_ao(precomputed_ao, comp, ip0, ip1)
             if abs(kpt1-kpt2).sum() < 1e-9:
                 ao_k1 = ao_k2
             else:
@@ -1024,7 +1199,8 @@ class _NumInt(numint._NumInt):
             yield ao_k1, ao_k2, non0, weight, coords
             ao_k1 = ao_k2 = None
 
-    def _gen_rho_evaluator(self, cell, dms, hermi=0):
+    def _gen_rho_evaluator(self, cell, dms, hermi=0, kpts=None):
+        # kpts is not needed for a single k-point
         return numint._NumInt._gen_rho_evaluator(self, cell, dms, hermi)
 
     nr_rks_fxc = nr_rks_fxc
@@ -1033,6 +1209,29 @@ class _NumInt(numint._NumInt):
     large_rho_indices = large_rho_indices
 
 
+class _AOCache(object):
+    '''AO values of block_loop, indexed by the first grid of each block.
+    Blocks are added until max_bytes is reached.  Later blocks are not
+    cached, so that a scan over the grids never evicts reusable blocks.
+    '''
+    def __init__(self, coords, key, max_bytes):
+        self.coords = coords
+        self.key = key
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.blocks = {}
+
+    def add(self, ip0, aos):
+        ao_k1, ao_k2 = aos
+        nbytes = sum(x.nbytes for x in ao_k2)
+        if ao_k1 is not ao_k2:
+            nbytes += sum(x.nbytes for x in ao_k1
+                          if not any(x is y for y in ao_k2))
+        if self.nbytes + nbytes <= self.max_bytes:
+            self.blocks[ip0] = aos
+            self.nbytes += nbytes
+
+
 class _KNumInt(numint._NumInt):
     '''Generalization of pyscf's _NumInt class for k-point sampling and
     periodic images.
@@ -1040,6 +1239,18 @@ class _KNumInt(numint._NumInt):
     def __init__(self, kpts=numpy.zeros((1,3))):
         numint._NumInt.__init__(self)
         self.kpts = numpy.reshape(kpts, (-1,3))
+        # Keep the AO values of the grid blocks in memory for the next
+        # block_loop call (e.g. the next SCF iteration).  Up to 30% of
+        # max_memory is used.  The cache is dropped when the cell, grids,
+        # k-points or derivative order change.
+        self.cache_ao = False
+        # Evaluate the AO values of the next grid block in a background
+        # thread while the current block is used.  The collocation and the
+        # density/XC GEMMs then run OpenMP regions at the same time, and two
+        # blocks are held in memory.
+        self.prefetch_ao = False
+        self._ao_cache = None
+        self._non0tab_cache = None
 
     def eval_ao(self, cell, coords, kpts=numpy.zeros((1,3)), deriv=0, relativity=0,
                 shl_slice=None, non0tab=None, out=None, verbose=None, **kwargs):
@@ -1052,7 +1263,7 @@ class _KNumInt(numint._NumInt):
         return make_mask(cell, coords, relativity, shls_slice, verbose)
 
     def eval_rho(self, cell, ao_kpts, dm_kpts, non0tab=None, xctype='LDA',
-                 hermi=0, verbose=None):
+                 hermi=0, verbose=None, kpt_weights=None, out=None):
         '''
         Args:
             cell : Mole or Cell object
@@ -1061,24 +1272,38 @@ class _KNumInt(numint._NumInt):
             dm_kpts: (nkpts, nao, nao) ndarray
                 Density matrix at each k-point
 
+        Kwargs:
+            kpt_weights : (nkpts,) ndarray
+                Weight of each k-point, see :func:`_kpt_pair_weights`.
+                k-points of zero weight are skipped.  Default is 1 for all
+                k-points.
+            out : ndarray
+                If given, the density is written to out.
+
         Returns:
            rhoR : (ngs,) ndarray
         '''
         nkpts = len(ao_kpts)
-        rhoR = 0
+        rhoR = None
         for k in range(nkpts):
-            rhoR += eval_rho(cell, ao_kpts[k], dm_kpts[k], non0tab, xctype,
-                             hermi, verbose)
+            if kpt_weights is not None and kpt_weights[k] == 0:
+                continue
+            rho = eval_rho(cell, ao_kpts[k], dm_kpts[k], non0tab, xctype,
+                           hermi, verbose)
+            if kpt_weights is not None and kpt_weights[k] != 1:
+                rho *= kpt_weights[k]
+            rhoR = _add_rho(rhoR, rho, out)
         rhoR *= 1./nkpts
         return rhoR
 
     def eval_rho2(self, cell, ao_kpts, mo_coeff_kpts, mo_occ_kpts,
-                  non0tab=None, xctype='LDA', verbose=None):
+                  non0tab=None, xctype='LDA', verbose=None, out=None):
         nkpts = len(ao_kpts)
-        rhoR = 0
+        rhoR = None
         for k in range(nkpts):
-            rhoR += eval_rho2(cell, ao_kpts[k], mo_coeff_kpts[k],
-                              mo_occ_kpts[k], non0tab, xctype, verbose)
+            rho = eval_rho2(cell, ao_kpts[k], mo_coeff_kpts[k],
+                            mo_occ_kpts[k], non0tab, xctype, verbose)
+            rhoR = _add_rho(rhoR, rho, out)
         rhoR *= 1./nkpts
         return rhoR
 
@@ -1094,35 +1319,35 @@ class _KNumInt(numint._NumInt):
             return self.nr_uks(cell, grids, xc_code, dms, hermi,
                                kpts, kpts_band, max_memory, verbose)
 
-    @lib.with_doc(nr_rks.__doc__)
-    def nr_rks(self, cell, grids, xc_code, dms, hermi=0, kpts=None, kpts_band=None,
-               max_memory=2000, verbose=None, **kwargs):
+    def _normalize_kpts(self, kpts, kwargs, caller):
+        '''kpts as a (nkpts,3) array.  Default is self.kpts, or the value of
+        the deprecated keyword argument "kpt" in kwargs.
+        '''
         if kpts is None:
             if 'kpt' in kwargs:
-                sys.stderr.write('WARN: _KNumInt.nr_rks function finds keyword '
-                                 'argument "kpt" and converts it to "kpts"\n')
-                kpts = kpt
+                sys.stderr.write('WARN: _KNumInt.%s function finds keyword '
+                                 'argument "kpt" and converts it to "kpts"\n'
+                                 % caller)
+                kpts = kwargs['kpt']
             else:
                 kpts = self.kpts
-        kpts = kpts.reshape(-1,3)
+        return numpy.reshape(kpts, (-1,3))
 
+    @lib.with_doc(nr_rks.__doc__)
+    def nr_rks(self, cell, grids, xc_code, dms, hermi=0, kpts=None, kpts_band=None,
+               max_memory=2000, verbose=None, precomputed_ao=None, **kwargs):
+        kpts = self._normalize_kpts(kpts, kwargs, 'nr_rks')
         return nr_rks(self, cell, grids, xc_code, dms, 0, 0,
-                      hermi, kpts, kpts_band, max_memory, verbose)
+                      hermi, kpts, kpts_band, max_memory, verbose,
+                      precomputed_ao)
 
     @lib.with_doc(nr_uks.__doc__)
     def nr_uks(self, cell, grids, xc_code, dms, hermi=0, kpts=None, kpts_band=None,
-               max_memory=2000, verbose=None, **kwargs):
-        if kpts is None:
-            if 'kpt' in kwargs:
-                sys.stderr.write('WARN: _KNumInt.nr_uks function finds keyword '
-                                 'argument "kpt" and converts it to "kpts"\n')
-                kpts = kpt
-            else:
-                kpts = self.kpts
-        kpts = kpts.reshape(-1,3)
-
+               max_memory=2000, verbose=None, precomputed_ao=None, **kwargs):
+        kpts = self._normalize_kpts(kpts, kwargs, 'nr_uks')
         return nr_uks(self, cell, grids, xc_code, dms, 1, 0,
-                      hermi, kpts, kpts_band, max_memory, verbose)
+                      hermi, kpts, kpts_band, max_memory, verbose,
+                      precomputed_ao)
 
     def eval_mat(self, cell, ao_kpts, weight, rho, vxc,
                  non0tab=None, xctype='LDA', spin=0, verbose=None):
@@ -1143,46 +1368,97 @@ class _KNumInt(numint._NumInt):
         return mat
 
     def block_loop(self, cell, grids, nao, deriv=0, kpts=numpy.zeros((1,3)),
-                   kpts_band=None, max_memory=2000, non0tab=None, blksize=None):
+                   kpts_band=None, max_memory=2000, non0tab=None, blksize=None,
+                   precomputed_ao=None):
         '''Define this macro to loop over grids by blocks.
         '''
         ngrids = grids.weights.size
         nkpts = len(kpts)
         comp = (deriv+1)*(deriv+2)*(deriv+3)//6
+        prefetch = self.prefetch_ao and precomputed_ao is None
 # NOTE to index grids.non0tab, the blksize needs to be the integer multiplier of BLKSIZE
+# With prefetch_ao, two blocks are held in memory and each gets half of max_memory.
         if blksize is None:
-            blksize = min(int(max_memory*1e6/(comp*2*nkpts*nao*16*BLKSIZE))*BLKSIZE, ngrids)
-            blksize = max(blksize, BLKSIZE)
-        if non0tab is None:
-            non0tab = grids.non0tab
+            if prefetch:
+                blksize = int(max_memory*.5e6/(comp*2*nkpts*nao*16*BLKSIZE))*BLKSIZE
+            else:
+                blksize = int(max_memory*1e6/(comp*2*nkpts*nao*16*BLKSIZE))*BLKSIZE
+            blksize = max(min(blksize, ngrids), BLKSIZE)
         if non0tab is None:
-            non0tab = numpy.empty(((ngrids+BLKSIZE-1)//BLKSIZE,cell.nbas),
-                                  dtype=numpy.uint8)
-            non0tab[:] = 0xff
+            non0tab = _grids_non0tab(self, cell, grids, ngrids, precomputed_ao)
         if kpts_band is not None:
             kpts_band = numpy.reshape(kpts_band, (-1,3))
             where = [member(k, kpts) for k in kpts_band]
             where = [k_id[0] if len(k_id)>0 else None for k_id in where]
+            # band k-points not found in kpts need their own AO values
+            new_idx = [i for i,w in enumerate(where) if w is None]
+            new_kpts = kpts_band[new_idx]
 
-        for ip0 in range(0, ngrids, blksize):
-            ip1 = min(ngrids, ip0+blksize)
+        if self.cache_ao and precomputed_ao is None:
+            ao_cache = self._get_ao_cache(cell, grids, deriv, kpts, kpts_band,
+                                          blksize, max_memory*.3e6)
+        else:
+            self._ao_cache = ao_cache = None
+
+        def eval_ao_blk(ip0, ip1):
+            if ao_cache is not None and ip0 in ao_cache.blocks:
+                return ao_cache.blocks[ip0]
             coords = grids.coords[ip0:ip1]
-            weight = grids.weights[ip0:ip1]
             non0 = non0tab[ip0//BLKSIZE:]
-            ao_k2 = self.eval_ao(cell, coords, kpts, deriv=deriv, non0tab=non0)
+            if precomputed_ao is None:
+                ao_k2 = self.eval_ao(cell, coords, kpts, deriv=deriv, non0tab=non0)
+            else:
+                ao_k2 = [_slice_ao(ao, comp, ip0, ip1) for ao in precomputed_ao]
             if kpts_band is None:
                 ao_k1 = ao_k2
             else:
-                new_kpts = [k for k,w in zip(kpts_band, where) if w is None]
-                new_ao = iter(self.eval_ao(cell, coords, new_kpts, deriv=deriv, non0tab=non0))
-                old_ao = (ao_k2[w] for w in where if not w is None)
-                ao_k1 = []
-                for w in where:
-                    ao_k1.append(next(new_ao) if w is None else next(old_ao))
-            yield ao_k1, ao_k2, non0, weight, coords
-            ao_k1 = ao_k2 = None
-
-    def _gen_rho_evaluator(self, cell, dms, hermi=0):
+                ao_k1 = [None if w is None else ao_k2[w] for w in where]
+                if new_idx:
+                    new_ao = self.eval_ao(cell, coords, new_kpts, deriv=deriv, non0tab=non0)
+                    for i, ao in zip(new_idx, new_ao):
+                        ao_k1[i] = ao
+            if ao_cache is not None:
+                ao_cache.add(ip0, (ao_k1, ao_k2))
+            return ao_k1, ao_k2
+
+        blocks = list(lib.prange(0, ngrids, blksize))
+        handler = None
+        try:
+            for i, (ip0, ip1) in enumerate(blocks):
+                if handler is None:
+                    ao_k1, ao_k2 = eval_ao_blk(ip0, ip1)
+                else:
+                    ao_k1, ao_k2 = handler.get()
+                    handler = None
+                if prefetch and i+1 < len(blocks):
+                    handler = lib.background_thread(eval_ao_blk, *blocks[i+1])
+                coords = grids.coords[ip0:ip1]
+                weight = grids.weights[ip0:ip1]
+                non0 = non0tab[ip0//BLKSIZE:]
+                yield ao_k1, ao_k2, non0, weight, coords
+                ao_k1 = ao_k2 = None
+        finally:
+            # The caller stopped early.  Wait for the prefetch so that it does
+            # not run (and update the AO cache) after the loop is left.
+            if handler is not None:
+                threading.Thread.join(handler)
+
+    def _get_ao_cache(self, cell, grids, deriv, kpts, kpts_band, blksize,
+                      max_bytes):
+        '''The AO cache of block_loop, renewed if any input changed'''
+        key = [deriv, blksize, kpts, kpts_band, cell._atm, cell._bas, cell._env]
+        if self._ao_cache is not None:
+            old = self._ao_cache
+            if (old.coords is grids.coords and
+                all(numpy.array_equal(a, b) if a is not None else b is None
+                    for a, b in zip(old.key, key))):
+                return old
+        self._ao_cache = _AOCache(grids.coords, [None if x is None else
+                                                 numpy.copy(x) for x in key],
+                                  max_bytes)
+        return self._ao_cache
+
+    def _gen_rho_evaluator(self, cell, dms, hermi=0, kpts=None):
         if hasattr(dms, 'mo_coeff'):
             mo_coeff = dms.mo_coeff
             mo_occ = dms.mo_occ
@@ -1203,9 +1479,20 @@ class _KNumInt(numint._NumInt):
                 dms = [(dm+dm.conj().transpose(0,2,1))*.5 for dm in dms]
             nao = dms[0].shape[-1]
             ndms = len(dms)
+            if kpts is None:
+                kpt_weights = [None] * ndms
+            else:
+                kpts = numpy.reshape(kpts, (-1,3))
+                kpt_weights = [_kpt_pair_weights(kpts, dm) for dm in dms]
+            orbs = [_low_rank_orbitals(dm, w) for dm, w in zip(dms, kpt_weights)]
             def make_rho(idm, ao_kpts, non0tab, xctype):
-                return self.eval_rho(cell, ao_kpts, dms[idm], non0tab, xctype,
-                                     hermi=1)
+                if orbs[idm] is None:
+                    return self.eval_rho(cell, ao_kpts, dms[idm], non0tab,
+                                         xctype, hermi=1,
+                                         kpt_weights=kpt_weights[idm])
+                else:
+                    return self.eval_rho2(cell, ao_kpts, orbs[idm][0],
+                                          orbs[idm][1], non0tab, xctype)
         return make_rho, ndms, nao
 
     nr_rks_fxc = nr_rks_fxc
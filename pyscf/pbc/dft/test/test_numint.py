@@ -55,6 +55,20 @@ def make_grids(n):
     grids.build()
     return cell, grids
 
+def make_he_cell():
+    cell = pbcgto.Cell()
+    cell.verbose = 0
+    cell.output = '/dev/null'
+    cell.a = np.eye(3) * 2.5
+    cell.gs = [10]*3
+    cell.atom = [['He', (1., .8, 1.9)],
+                 ['He', (.1, .2,  .3)],]
+    cell.basis = 'ccpvdz'
+    cell.build(False, False)
+    grids = gen_grid.UniformGrids(cell)
+    grids.build()
+    return cell, grids
+
 
 class KnowValues(unittest.TestCase):
     def test_eval_ao(self):
@@ -183,6 +197,126 @@ class KnowValues(unittest.TestCase):
         self.assertAlmostEqual(finger(vmat[1][0]), -2348.9577179701278-60.733087913116719j, 7)
         self.assertAlmostEqual(finger(vmat[1][1]), -2353.0350086740673-117.74811536967495j, 7)
 
+    def test_cache_ao(self):
+        cell, grids = make_he_cell()
+        nao = cell.nao_nr()
+        np.random.seed(1)
+        kpts = np.random.random((2,3))
+        dms = np.random.random((2,nao,nao))
+        dms = (dms + dms.transpose(0,2,1)) * .5
+        ni = numint._KNumInt()
+        ne0, exc0, vmat0 = ni.nr_rks(cell, grids, 'blyp', dms, 0, kpts)
+
+        ni1 = numint._KNumInt()
+        ni1.cache_ao = True
+        # The second call takes the AO values from the cache
+        for i in range(2):
+            ne1, exc1, vmat1 = ni1.nr_rks(cell, grids, 'blyp', dms, 0, kpts)
+            self.assertAlmostEqual(ne1, ne0, 9)
+            self.assertAlmostEqual(exc1, exc0, 9)
+            self.assertTrue(numpy.allclose(vmat1, vmat0))
+        self.assertTrue(len(ni1._ao_cache.blocks) > 0)
+
+        # A change of k-points renews the cache
+        ne0, exc0, vmat0 = ni.nr_rks(cell, grids, 'blyp', dms, 0, kpts*.5)
+        ne1, exc1, vmat1 = ni1.nr_rks(cell, grids, 'blyp', dms, 0, kpts*.5)
+        self.assertAlmostEqual(ne1, ne0, 9)
+        self.assertAlmostEqual(exc1, exc0, 9)
+        self.assertTrue(numpy.allclose(vmat1, vmat0))
+
+    def test_precomputed_ao(self):
+        cell, grids = make_he_cell()
+        nao = cell.nao_nr()
+        np.random.seed(1)
+        kpts = np.random.random((2,3))
+        dms = np.random.random((2,2,nao,nao))
+        dms = (dms + dms.transpose(0,1,3,2)) * .5
+
+        ni = numint._NumInt()
+        ao = ni.eval_ao(cell, grids.coords, kpts[0], deriv=1)
+        for xc in ('lda,vwn', 'blyp'):
+            ne0, exc0, vmat0 = ni.nr_rks(cell, grids, xc, dms[0,0], 0, kpts[0])
+            ne1, exc1, vmat1 = ni.nr_rks(cell, grids, xc, dms[0,0], 0, kpts[0],
+                                         precomputed_ao=ao)
+            self.assertAlmostEqual(ne1, ne0, 9)
+            self.assertAlmostEqual(exc1, exc0, 9)
+            self.assertTrue(numpy.allclose(vmat1, vmat0))
+
+        ni = numint._KNumInt()
+        ao = ni.eval_ao(cell, grids.coords, kpts, deriv=1)
+        ne0, exc0, vmat0 = ni.nr_rks(cell, grids, 'blyp', dms[0], 0, kpts)
+        ne1, exc1, vmat1 = ni.nr_rks(cell, grids, 'blyp', dms[0], 0, kpts,
+                                     precomputed_ao=ao)
+        self.assertAlmostEqual(ne1, ne0, 9)
+        self.assertAlmostEqual(exc1, exc0, 9)
+        self.assertTrue(numpy.allclose(vmat1, vmat0))
+
+        ne0, exc0, vmat0 = ni.nr_uks(cell, grids, 'blyp', dms, 0, kpts)
+        ne1, exc1, vmat1 = ni.nr_uks(cell, grids, 'blyp', dms, 0, kpts,
+                                     precomputed_ao=ao)
+        self.assertTrue(numpy.allclose(ne1, ne0))
+        self.assertAlmostEqual(exc1, exc0, 9)
+        self.assertTrue(numpy.allclose(vmat1, vmat0))
+
+    def test_kpt_pair_weights(self):
+        cell, grids = make_he_cell()
+        nao = cell.nao_nr()
+        np.random.seed(1)
+        k1, k2 = np.random.random((2,3))
+        kpts = np.vstack((k1, -k1, k2))
+        dms = np.random.random((3,nao,nao)) + np.random.random((3,nao,nao))*1j
+        dms = (dms + dms.conj().transpose(0,2,1)) * .5
+        dms[1] = dms[0].conj()
+        weights = numint._kpt_pair_weights(kpts, dms)
+        self.assertTrue(numpy.allclose(weights, [2, 0, 1]))
+        dms[1] += .1
+        weights = numint._kpt_pair_weights(kpts, dms)
+        self.assertTrue(numpy.allclose(weights, [1, 1, 1]))
+        dms[1] = dms[0].conj()
+
+        ni = numint._KNumInt()
+        for xctype, deriv in (('LDA', 0), ('GGA', 1)):
+            ao = ni.eval_ao(cell, grids.coords, kpts, deriv=deriv)
+            rho0 = ni.eval_rho(cell, ao, dms, xctype=xctype, hermi=1)
+            rho1 = ni.eval_rho(cell, ao, dms, xctype=xctype, hermi=1,
+                               kpt_weights=[2, 0, 1])
+            self.assertTrue(numpy.allclose(rho0, rho1))
+
+        # nr_rks picks the weights up through _gen_rho_evaluator
+        self.assertTrue(numint._low_rank_orbitals(dms) is None)
+        make_rho = ni._gen_rho_evaluator(cell, dms, 1, kpts)[0]
+        rho1 = make_rho(0, ao, None, 'GGA')
+        self.assertTrue(numpy.allclose(rho0, rho1))
+
+    def test_low_rank_dm(self):
+        cell, grids = make_he_cell()
+        nao = cell.nao_nr()
+        np.random.seed(1)
+        k1, k2 = np.random.random((2,3))
+        kpts = np.vstack((k1, -k1, k2))
+        c = np.random.random((3,nao,2)) + np.random.random((3,nao,2))*1j
+        c[1] = c[0].conj()
+        dms = np.einsum('kpi,i,kqi->kpq', c, [2., .5], c.conj())
+
+        mo_coeff, mo_occ = numint._low_rank_orbitals(dms)
+        for k in range(3):
+            dm = np.dot(mo_coeff[k]*mo_occ[k], mo_coeff[k].conj().T)
+            self.assertTrue(numpy.allclose(dm, dms[k]))
+        # Negative occupations or a high rank use eval_rho
+        self.assertTrue(numint._low_rank_orbitals(dms - np.eye(nao)*.1) is None)
+        self.assertTrue(numint._low_rank_orbitals(dms + np.eye(nao)) is None)
+
+        ni = numint._KNumInt()
+        make_rho = ni._gen_rho_evaluator(cell, dms, 1, kpts)[0]
+        for xctype, deriv in (('LDA', 0), ('GGA', 1)):
+            ao = ni.eval_ao(cell, grids.coords, kpts, deriv=deriv)
+            rho0 = ni.eval_rho(cell, ao, dms, xctype=xctype, hermi=1)
+            rho1 = make_rho(0, ao, None, xctype)
+            self.assertTrue(numpy.allclose(rho0, rho1))
+
+        ne = ni.nr_rks(cell, grids, 'blyp', dms, 1, kpts)[0]
+        self.assertAlmostEqual(ne, np.dot(rho0[0], grids.weights), 9)
+
     def test_eval_rho(self):
         cell, grids = make_grids(30)
         numpy.random.seed(10)